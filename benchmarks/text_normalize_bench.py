@@ -0,0 +1,74 @@
+"""
+Benchmark text cleaning on the bundled `doc/pg24022.txt`.
+
+Run from the repository root:
+
+    python benchmarks/text_normalize_bench.py
+"""
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.text_normalize import clean_text, normalize_text
+
+DOC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'doc', 'pg24022.txt')
+PAGE_SIZE = 3000
+
+
+def clean_text_loop(text: str) -> str:
+    """
+    Previous `RAGv1.clean_text`, kept as the baseline
+    """
+    text = text.replace('-\n', '')
+    text = text.replace('\n', ' ')
+    text = text.replace(u'\xa0', u' ')
+
+    while text.find('  ') != -1:
+        text = text.replace('  ', ' ')
+
+    return text
+
+
+def timeit(func, pages: list[str], repeat: int = 5) -> float:
+    """
+    Return the best total time (seconds) of cleaning all `pages`
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            func(page)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def main():
+    with open(DOC_PATH, 'r', encoding='utf-8') as fp:
+        text = fp.read()
+
+    # Results of the new and old cleaning must be the same
+    assert clean_text(text) == clean_text_loop(text)
+
+    pages = [text[i:i + PAGE_SIZE] for i in range(0, len(text), PAGE_SIZE)]
+    print(f"Document: {len(text)} characters, {len(pages)} pages of {PAGE_SIZE} characters\n")
+
+    print(f"{'function':<16}{'total (ms)':>12}{'per page (us)':>16}")
+    for name, func in [("clean_text_loop", clean_text_loop), ("clean_text", clean_text), ("normalize_text", normalize_text)]:
+        total = timeit(func, pages)
+        print(f"{name:<16}{total * 1000:>12.2f}{total / len(pages) * 1e6:>16.2f}")
+
+    # Per-page cost must grow linearly with page size, also with long whitespace runs (e.g. tables in pdf)
+    print(f"\n{'page size':>10}{'run length':>12}{'loop (us)':>12}{'clean (us)':>12}{'clean / char (ns)':>20}")
+    for scale in [1, 2, 4, 8, 16]:
+        for run in [2, 64, 1024]:
+            page = (text[:PAGE_SIZE] + ' ' * run) * scale
+            loop = timeit(clean_text_loop, [page], repeat=20)
+            clean = timeit(clean_text, [page], repeat=20)
+            print(f"{len(page):>10}{run:>12}{loop * 1e6:>12.1f}{clean * 1e6:>12.1f}{clean / len(page) * 1e9:>20.2f}")
+
+
+if __name__ == "__main__":
+    main()
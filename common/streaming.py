@@ -0,0 +1,72 @@
+"""Generator helpers of the ingestion pipelines"""
+
+import queue
+import threading
+
+def batched(iterable, batch_size: int):
+    """
+    Yield lists of `batch_size` items from `iterable`, the last batch may be smaller
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class _Done:
+    pass
+
+
+def prefetch(iterable, max_in_flight: int = 2):
+    """
+    Consume `iterable` in a background thread and yield its items. At most `max_in_flight` items are
+    produced ahead of the consumer, so the producer is paused when the consumer is slower (backpressure).
+
+    An exception raised by the producer is raised again in the consumer
+    """
+    buffer = queue.Queue(maxsize=max(1, max_in_flight))
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        """
+        Wait for a free slot, return False if the consumer has stopped
+        """
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+
+            put(_Done())
+        except BaseException as error:
+            put(error)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if isinstance(item, _Done):
+                return
+            if isinstance(item, BaseException):
+                raise item
+
+            yield item
+    finally:
+        # Consumer stopped early, release the producer
+        stop.set()
@@ -0,0 +1,38 @@
+"""Linear-time text cleaning shared by every ingestion pipeline"""
+
+import re
+
+# Runs of 2 or more spaces. The literal prefix lets the regex engine skip single spaces quickly
+_MULTI_SPACE = re.compile(r'  +')
+
+# Line breaks with only spaces between them
+_BLANK_LINES = re.compile(r'\n(?: *\n)+')
+
+# Whitespace characters which are replaced by a normal space. `str.replace` of a single
+# character is much faster than `str.translate` or a character class regex
+_SPACE_CHARS = ['\t', '\xa0', '\f', '\v']
+
+
+def clean_text(text: str) -> str:
+    """
+    Join hyphenated line breaks, turn line breaks into spaces and collapse runs of spaces.
+    Each step is a single pass over `text`
+    """
+    text = text.replace('-\n', '').replace('\n', ' ').replace('\xa0', ' ')
+
+    return _MULTI_SPACE.sub(' ', text)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Collapse runs of spaces and blank lines, while keeping paragraph breaks (`\\n\\n`)
+    so paragraph based splitters still work. Each step is a single pass over `text`
+    """
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    for char in _SPACE_CHARS:
+        text = text.replace(char, ' ')
+
+    text = _MULTI_SPACE.sub(' ', text)
+    text = _BLANK_LINES.sub('\n\n', text)
+
+    return text.strip()
@@ -6,6 +6,10 @@ import pymupdf
 from transformers import AutoTokenizer, AutoModel
 from dotenv import load_dotenv
 import google.generativeai as genai
+from vector_store import VectorStore, file_hash
+
+from common.streaming import batched, prefetch
+from common.text_normalize import clean_text
 
 # NOTE: require .env contain API_KEY for google generative ai key
 
@@ -18,32 +22,70 @@ genai.configure(api_key=API_KEY)
 
 
 class RAGv1:
-    def __init__(self, file_path: str, chunk_size=32) -> None:
+    def __init__(self, file_path: str, chunk_size=32, index_dir: str | None = None, batch_size=256, max_in_flight=2) -> None:
+        """
+        Parameters
+        -
+        index_dir: folder of the persisted index. Default is `<file_path>.index`. The index is only rebuilt
+        when the document, the embedding model or `chunk_size` has changed
+
+        batch_size, max_in_flight: number of chunks embedded at once, and number of chunk batches parsed
+        ahead of the embedding model when the index is built
+        """
         # Load embedding model
         self.load_embedded_model()
 
         # Load gemini model
         self.gen_model = genai.GenerativeModel('gemini-1.0-pro-latest')
 
-        # Generate chunks
-        chunks = self.load_document(file_path, chunk_size)
-        # chunks: list of object {chunk_id, page, text}
+        self.index_dir = index_dir if index_dir is not None else file_path + ".index"
+        self.__store = VectorStore(self.index_dir)
 
-        # Build vector store
-        self.text = [chunk['text'] for chunk in chunks]
-        self.vector_store = {}
+        meta = {"model_name": self.model_name, "source_hash": file_hash(file_path), "chunk_size": chunk_size}
+        if not self.__store.is_valid(**meta):
+            print("Building index...")
+            self.build_index(file_path, chunk_size, meta, batch_size, max_in_flight)
+            self.__store = VectorStore(self.index_dir)
 
-        batch_size = 1000
+    @property
+    def vector_store(self):
+        """
+        (num_chunks, d_embed) memory-mapped float32 matrix of normalized vectors, row i is chunk i.
+        The index is opened on first access
+        """
+        if self.__store.vectors is None:
+            self.__store.open()
 
-        vectors = []
-        num_batch = len(chunks) // batch_size
+        return self.__store.vectors
 
-        for i in range(num_batch + 1):
-            print(f"Embedding batch {i + 1}")
-            vectors += self.get_embedding(self.text[i * batch_size : (i + 1) * batch_size])
+    @property
+    def text(self):
+        """
+        Chunk texts, `text[i]` is chunk i
+        """
+        if self.__store.text is None:
+            self.__store.open()
 
-        for id, vector in vectors:
-            self.vector_store[id] = np.array(vector, dtype=np.float32)
+        return self.__store.text
+
+    def build_index(self, file_path: str, chunk_size: int, meta: dict, batch_size=256, max_in_flight=2):
+        """
+        Chunk and embed document `file_path`, then write the index to `index_dir`.
+
+        Pages are parsed and chunked in a background thread while previous batches are embedded.
+        At most `max_in_flight` batches wait for the embedding model, so memory stays bounded
+        regardless of document size
+        """
+        texts = (chunk['text'] for chunk in self.iter_chunks(file_path, chunk_size))
+
+        writer = self.__store.writer(**meta)
+        for i, batch in enumerate(prefetch(batched(texts, batch_size), max_in_flight)):
+            if (i + 1) % 10 == 0:
+                print(f"Embedding batch {i + 1}")
+
+            writer.append(batch, self.normalize(self.get_embedding(batch)))
+
+        writer.close()
 
         
             
@@ -51,8 +93,13 @@ class RAGv1:
         """
         Loads pdf from `file_path` and generate list of chunks from the file
         """
+        return list(self.iter_chunks(file_path, chunk_size))
+
+    def iter_chunks(self, file_path: str, chunk_size=32):
+        """
+        Yield chunks of pdf `file_path` page by page, only the current page is kept in memory
+        """
         doc = pymupdf.open(file_path)
-        output = []
 
         chunk_id = 0
         for i, page in enumerate(doc):
@@ -66,31 +113,20 @@ class RAGv1:
             for j in range(0, len(words) - chunk_size + 1, 2):
                 chunk = ' '.join(words[j:j + chunk_size])
 
-                output.append({
+                yield {
                     'chunk_id': chunk_id,
                     'page': i,
                     'text': chunk,
-                })
+                }
 
                 chunk_id += 1
         
-        return output  
-        
        
     def clean_text(self, text: str):
         """
         Remove escaped and special characters from `text`
         """
-        # filter = ''.join([chr(i) for i in range(1, 32)])
-        # text = text.translate(str.maketrans('', '', filter)).strip()
-        text = text.replace('-\n', '')
-        text = text.replace('\n', ' ')
-        text = text.replace(u'\xa0', u' ')
-
-        while text.find('  ') != -1:
-            text = text.replace('  ', ' ') 
-
-        return text
+        return clean_text(text)
 
     
     def load_embedded_model(self, model_name: str="BAAI/bge-small-en-v1.5"):
@@ -98,6 +134,7 @@ class RAGv1:
         Load model to embed string
         """
         self.device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        self.model_name = model_name
 
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         self.model = AutoModel.from_pretrained(model_name)
@@ -115,6 +152,16 @@ class RAGv1:
 
         return output.tolist()
     
+    def normalize(self, vectors):
+        """
+        Return float32 matrix of L2-normalized `vectors`, so cosine similarity is a dot product
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+
+        return vectors / norms
+
     def cosine_similarity(self, a, b):
         norm_a = np.linalg.norm(a)
         norm_b = np.linalg.norm(b)
@@ -124,24 +171,35 @@ class RAGv1:
         else:
             return np.dot(a, b) / (norm_a * norm_b)
         
-    def get_matches(self, vector_store, query: str, top_k: int=100):
+    def get_matches(self, vector_store, query: str | list[str], top_k: int=100):
+        """
+        Return `top_k` (chunk_id, cosine score) pairs sorted by score, and the list of chunk ids.
+        `vector_store` is a normalized (num_chunks, d_embed) matrix.
+
+        If `query` is a list, all queries are searched in one batch and a list of results is returned
+        """
+        queries = [query] if isinstance(query, str) else query
+
         # Embedding query
-        ce_output = self.get_embedding(query)[0] # (1, 384)
+        ce_output = self.normalize(self.get_embedding(queries)) # (num_queries, 384)
 
-        scores = {}
+        # Cosine scores of all chunks
+        similarity = ce_output @ vector_store.T # (num_queries, num_chunks)
 
-        for vector_key in vector_store:
-            vector_item = vector_store[vector_key]
-            scores[vector_key] = self.cosine_similarity(ce_output, vector_item)
+        # Only sort the top k scores
+        top_k = min(top_k, similarity.shape[1])
+        top_ids = np.argpartition(-similarity, top_k - 1, axis=1)[:, :top_k]
+        top_scores = np.take_along_axis(similarity, top_ids, axis=1)
 
-        def func(e):
-            return e[1]
-        
-        # Sorted by cosine scores
-        scores = sorted(scores.items(), key=func, reverse=True)[:top_k]
-        ids = [score[0] for score in scores]
+        order = np.argsort(-top_scores, axis=1)
+        top_ids = np.take_along_axis(top_ids, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+        output = []
+        for ids, scores in zip(top_ids.tolist(), top_scores.tolist()):
+            output.append((list(zip(ids, scores)), ids))
 
-        return scores, ids
+        return output[0] if isinstance(query, str) else output
     
     def create_prompt(self, query: str, info: list[str]):
         ret = '\n- '
@@ -154,7 +212,7 @@ class RAGv1:
     def call(self, query: str):
         scores, match_ids = self.get_matches(self.vector_store, query)
 
-        info = [self.text for id in match_ids]
+        info = [self.text[id] for id in match_ids]
 
         prompt = self.create_prompt(query, info)
 
@@ -0,0 +1,140 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+# On-disk vector store of RAGv1, so the index is not rebuilt on every start
+
+
+def file_hash(file_path: str) -> str:
+    """
+    Return sha256 digest of file content
+    """
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+class ChunkTexts:
+    """
+    Read-only list of chunk texts backed by a memory-mapped file, a text is decoded when it is accessed
+    """
+    def __init__(self, data, offsets):
+        self.__data = data
+        self.__offsets = offsets
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.__data[self.__offsets[i]:self.__offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class VectorStoreWriter:
+    """
+    Append chunks and their vectors to a store. The metadata file is written last by `close`,
+    so an interrupted build is never considered valid
+    """
+    def __init__(self, folder: str, meta: dict):
+        self.folder = folder
+        self.meta = meta
+        self.count = 0
+        self.dim = None
+
+        os.makedirs(folder, exist_ok=True)
+
+        # Invalidate previous index before overwriting it
+        if os.path.exists(os.path.join(folder, "meta.json")):
+            os.remove(os.path.join(folder, "meta.json"))
+
+        self.__vector_fp = open(os.path.join(folder, "vectors.f32"), 'wb')
+        self.__text_fp = open(os.path.join(folder, "texts.bin"), 'wb')
+        self.__offsets = [0]
+
+    def append(self, texts: list[str], vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        assert len(texts) == vectors.shape[0]
+
+        if self.dim is None:
+            self.dim = int(vectors.shape[1])
+
+        self.__vector_fp.write(vectors.tobytes())
+        for text in texts:
+            data = text.encode('utf-8')
+            self.__text_fp.write(data)
+            self.__offsets.append(self.__offsets[-1] + len(data))
+
+        self.count += len(texts)
+
+    def close(self):
+        self.__vector_fp.close()
+        self.__text_fp.close()
+        np.save(os.path.join(self.folder, "offsets.npy"), np.array(self.__offsets, dtype=np.int64))
+
+        with open(os.path.join(self.folder, "meta.json"), 'w') as fp:
+            json.dump({**self.meta, "dim": self.dim, "count": self.count}, fp)
+
+
+class VectorStore:
+    """
+    Persisted index stored in `folder`:
+
+    - vectors.f32: (count, dim) float32 matrix of normalized vectors
+    - texts.bin: utf-8 chunk texts, concatenated
+    - offsets.npy: byte offset of each text in texts.bin
+    - meta.json: model name, dimension, chunk size and hash of source document
+
+    Files are memory-mapped on `open`, so loading does not copy the index into memory
+    """
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.meta = None
+        self.vectors = None
+        self.text = None
+
+        meta_path = os.path.join(folder, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as fp:
+                self.meta = json.load(fp)
+
+    def is_valid(self, **meta) -> bool:
+        """
+        Check if the stored index was built with the same `meta` (model name, source hash, ...)
+        """
+        if self.meta is None:
+            return False
+
+        return all(self.meta.get(key) == value for key, value in meta.items())
+
+    def writer(self, **meta) -> VectorStoreWriter:
+        return VectorStoreWriter(self.folder, meta)
+
+    def open(self):
+        """
+        Memory-map vectors and texts
+        """
+        assert self.meta is not None, f"No index found in {self.folder}"
+
+        count, dim = self.meta["count"], self.meta["dim"]
+        offsets = np.load(os.path.join(self.folder, "offsets.npy"), mmap_mode='r')
+
+        if count == 0:
+            self.vectors = np.zeros((0, dim or 0), dtype=np.float32)
+            self.text = ChunkTexts(b'', offsets)
+            return self
+
+        self.vectors = np.memmap(os.path.join(self.folder, "vectors.f32"), dtype=np.float32, mode='r', shape=(count, dim))
+
+        data = b''
+        if offsets[-1] > 0:
+            data = np.memmap(os.path.join(self.folder, "texts.bin"), dtype=np.uint8, mode='r')
+        self.text = ChunkTexts(data, offsets)
+
+        return self
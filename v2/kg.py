@@ -10,6 +10,9 @@ from langchain_community.graphs import Neo4jGraph
 import google.generativeai as genai
 from llama_index.embeddings.gemini import GeminiEmbedding
 
+from common.streaming import batched, prefetch
+from common.text_normalize import normalize_text
+
 # NOTE
 # This is just a clear structure of the system
 
@@ -41,30 +44,53 @@ class KG:
         """
         Read data from `file_path`, return list of chunk nodes
         """
-        # Read string from pdf
+        return list(self.iter_chunks(file_path))
+
+    def iter_text_chunks(self, file_path: str, chunk_size=1500, chunk_overlap=200):
+        """
+        Yield text chunks of pdf `file_path`. Pages are read one by one, only the text which
+        has not been chunked yet is kept in memory
+        """
         doc = pymupdf.open(file_path)
-        doc_text = '\n\n'.join([doc[i].get_text() for i in range(2, len(doc))])
 
-        # Create chunks
         text_splitter = CharacterTextSplitter(
             separator="\n\n",
-            chunk_size=1500,
-            chunk_overlap=200,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
         )
 
-        chunks = text_splitter.split_text(doc_text)
+        buffer = ""
+        for i in range(2, len(doc)):
+            page_text = normalize_text(doc[i].get_text())
+            buffer = buffer + "\n\n" + page_text if buffer else page_text
+
+            # Wait for enough text, so chunk boundaries are approximately the same as splitting the whole document
+            if len(buffer) < 4 * chunk_size:
+                continue
+
+            chunks = text_splitter.split_text(buffer)
+
+            # The last chunk may continue on the next page, it is split again with the next page
+            yield from chunks[:-1]
+            buffer = chunks[-1] if chunks else ""
 
-        # Embedding chunks
-        embed_chunks = []
+        if buffer:
+            yield from text_splitter.split_text(buffer)
+
+    def iter_chunks(self, file_path: str, batch_size=50, max_in_flight=4):
+        """
+        Yield chunk nodes `{chunk, embedding}` of `file_path`. Text chunks are produced in a background
+        thread and embedded in batches of `batch_size`, at most `max_in_flight` batches wait for embedding
+        """
         count = 0
+        for batch in prefetch(batched(self.iter_text_chunks(file_path), batch_size), max_in_flight):
+            embeddings = self.embed_model.get_text_embedding_batch(batch)
 
-        for chunk in chunks:
-            embed_chunks.append(self.embed_model.get_text_embedding(chunk))
-            count += 1
-            if count % 10 == 0:
-                print("Chunk count: %d" % count)
+            for chunk, embedding in zip(batch, embeddings):
+                yield {'chunk': chunk, 'embedding': embedding}
 
-        return [{'chunk': chunks[i], 'embedding': embed_chunks[i]} for i in range(len(chunk))]
+            count += len(batch)
+            print("Chunk count: %d" % count)
 
 
 
@@ -84,14 +110,11 @@ class KG:
         self.kg.query(query, params={'docId': docId, 'title': title, 'author': author})
 
 
-        print("Getting data...")
-        data = self.get_chunks(file_path)
-
         print("Building graph...")
 
         # Create first chunk as head of linked list
-        query = """
-        MERGE (c: Chunk {chunkId: $firstChunkId)
+        first_query = """
+        MERGE (c: Chunk {chunkId: $firstChunkId})
         SET c.text = $row.chunk
         WITH c
         CALL db.create.setNodeVectorProperty(c, "embedding", $row.embedding) 
@@ -100,8 +123,6 @@ class KG:
         MERGE (c)-[:PART_OF]->(d)
         """
 
-        self.kg.query(query, params={"row": data[0], "firstChunkId": docId + "-chunk-0000", "docId": docId})
-
         # Add other chunks to the graph
         query = """
         MERGE (c: Chunk {chunkId: $chunkId})
@@ -115,19 +136,25 @@ class KG:
         MATCH (c1: Chunk {chunkId: $prevChunkId})
         MERGE (c1)-[:NEXT]->(c)
         """
+        # Chunks are written as soon as they are embedded
         node_count = 0
-        for i in range(1, len(data)):
+        for i, row in enumerate(self.iter_chunks(file_path)):
+            if i == 0:
+                self.kg.query(first_query, params={"row": row, "firstChunkId": docId + "-chunk-0000", "docId": docId})
+                node_count += 1
+                continue
+
             chunkId = docId + "-chunk-" + str(i).zfill(4)
             prevChunkId = docId + "-chunk-" + str(i - 1).zfill(4)
             
-            self.kg.query(query, params={"chunkId": chunkId, "prevChunkId": prevChunkId, "docId": docId, "row": data[i]})
+            self.kg.query(query, params={"chunkId": chunkId, "prevChunkId": prevChunkId, "docId": docId, "row": row})
 
             if (node_count + 1) % 100 == 0:
                 print("Node count: %d" % (node_count + 1))
 
             node_count += 1
 
-        print("Total nodes are created: %d" % (node_count + 1)) 
+        print("Total nodes are created: %d" % node_count) 
 
         # Create index for chunks
         query = """
@@ -1,15 +1,26 @@
 from dotenv import load_dotenv
 import os
+import tempfile
+import torch
+from transformers import AutoTokenizer, AutoModel
 from llama_index.embeddings.gemini import GeminiEmbedding
+from cache import EmbeddingCache
+from checkpoint import hash_text
 
 class EmbeddingModel:
     def __init__(self):
         load_dotenv()
-        pass
+        self.model_name = type(self).__name__
 
     def embed(self, text: str):
         pass
 
+    def embed_batch(self, texts: list[str], batch_size: int = 100):
+        """
+        Embed list of texts. By default, each text is embedded separately
+        """
+        return [self.embed(text) for text in texts]
+
 
 class GeminiEmbeddingModel(EmbeddingModel):
     def __init__(self, model_name="models/embedding-001"):
@@ -18,7 +29,170 @@ class GeminiEmbeddingModel(EmbeddingModel):
         # Check if api key is valid
         assert GOOGLE_API_KEY
 
+        self.model_name = model_name
         self.__embed_model = GeminiEmbedding(model_name, api_key=GOOGLE_API_KEY)
 
     def embed(self, text: str):
-        return self.__embed_model.get_text_embedding(text)
\ No newline at end of file
+        return self.__embed_model.get_text_embedding(text)
+
+    def embed_batch(self, texts: list[str], batch_size: int = 100):
+        """
+        Embed list of texts with Gemini batch endpoint, `batch_size` texts per request (maximum is 100)
+        """
+        output = []
+        for i in range(0, len(texts), batch_size):
+            output += self.__embed_model.get_text_embedding_batch(texts[i:i + batch_size])
+
+        return output
+
+
+class LocalEmbeddingModel(EmbeddingModel):
+    """
+    Local transformer embedding model, no API call is needed. Default model is the same as v1.
+
+    Texts are tokenized once and sorted by length, then grouped into batches of at most `batch_size` texts
+    and `max_batch_tokens` padded tokens, so each batch is padded only to similar lengths.
+
+    Parameters
+    -
+    num_threads: number of CPU threads used for inference. None keeps the library default
+
+    backend: "torch" or "onnx" (requires `optimum[onnxruntime]`)
+
+    quantize: If true, run with int8 dynamic quantization (CPU only)
+
+    pooling: "mean" (masked mean of last hidden state, as v1) or "cls"
+    """
+    def __init__(self, model_name: str = "BAAI/bge-small-en-v1.5", batch_size: int = 64, max_batch_tokens: int = 16384,
+                 max_length: int = 512, num_threads: int | None = None, device: str | None = None,
+                 backend: str = "torch", quantize: bool = False, pooling: str = "mean", normalize: bool = True):
+        super().__init__()
+        assert backend in ("torch", "onnx")
+        assert pooling in ("mean", "cls")
+
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_length = max_length
+        self.pooling = pooling
+        self.normalize = normalize
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        # Quantized and ONNX models run on CPU
+        if device is None:
+            device = "cuda:0" if torch.cuda.is_available() and backend == "torch" and not quantize else "cpu"
+        self.device = device
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        if backend == "onnx":
+            self.model = self.__load_onnx_model(model_name, quantize, num_threads)
+        else:
+            self.model = AutoModel.from_pretrained(model_name)
+            self.model.eval()
+
+            if quantize:
+                self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+            self.model.to(self.device)
+
+    def __load_onnx_model(self, model_name: str, quantize: bool, num_threads: int | None):
+        try:
+            import onnxruntime
+            from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+            from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        except ImportError as error:
+            raise ImportError("ONNX backend requires `optimum[onnxruntime]` package") from error
+
+        session_options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True, session_options=session_options)
+
+        if quantize:
+            save_dir = tempfile.mkdtemp()
+            quantizer = ORTQuantizer.from_pretrained(model)
+            quantizer.quantize(save_dir=save_dir, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+            model = ORTModelForFeatureExtraction.from_pretrained(save_dir, file_name="model_quantized.onnx", session_options=session_options)
+
+        return model
+
+    def __batches(self, lengths: list[int], batch_size: int):
+        """
+        Group text indexes sorted by token length into batches limited by `batch_size` and `max_batch_tokens`
+        """
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+
+        batch = []
+        for i in order:
+            # Texts are sorted, so the current text is the longest of the batch
+            if batch and (len(batch) >= batch_size or (len(batch) + 1) * lengths[i] > self.max_batch_tokens):
+                yield batch
+                batch = []
+            batch.append(i)
+
+        if batch:
+            yield batch
+
+    def embed(self, text: str):
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: list[str], batch_size: int | None = None):
+        batch_size = batch_size or self.batch_size
+
+        encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+        lengths = [len(ids) for ids in encoded["input_ids"]]
+        output = [None] * len(texts)
+
+        with torch.inference_mode():
+            for batch in self.__batches(lengths, batch_size):
+                features = [{key: encoded[key][i] for key in encoded.keys()} for i in batch]
+                inputs = self.tokenizer.pad(features, return_tensors='pt').to(self.device)
+
+                hidden = self.model(**inputs).last_hidden_state
+
+                if self.pooling == "cls":
+                    vectors = hidden[:, 0]
+                else:
+                    mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+                    vectors = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+                if self.normalize:
+                    vectors = torch.nn.functional.normalize(vectors, dim=-1)
+
+                for i, vector in zip(batch, vectors.float().cpu().tolist()):
+                    output[i] = vector
+
+        return output
+
+
+class CachedEmbeddingModel(EmbeddingModel):
+    """
+    Wrap `em` with a persistent vector cache keyed by hash of model name and text,
+    only texts which have not been embedded yet are sent to the model
+    """
+    def __init__(self, em: EmbeddingModel, cache: EmbeddingCache):
+        super().__init__()
+        self.em = em
+        self.cache = cache
+        self.model_name = em.model_name
+
+    def embed(self, text: str):
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: list[str], batch_size: int = 100):
+        keys = [hash_text(self.model_name, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if len(missing) > 0:
+            embedded = self.em.embed_batch([texts[i] for i in missing], batch_size)
+            self.cache.put_many([keys[i] for i in missing], embedded)
+
+            for i, vector in zip(missing, embedded):
+                vectors[i] = vector
+
+        return [vector.tolist() if hasattr(vector, "tolist") else list(vector) for vector in vectors]
@@ -1,7 +1,14 @@
 from dotenv import load_dotenv
 import os
 import time
-from openai import OpenAI
+import asyncio
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rate_limiter import RateLimiter
+from cache import ResponseCache
+from checkpoint import hash_text
+from openai import OpenAI, AsyncOpenAI
 import google.generativeai as genai
 
 
@@ -9,56 +16,322 @@ import google.generativeai as genai
 class LLM:
     """
     Large Language Model interface
+
+    Concrete models implement `_generate` (and optionally `_agenerate` and `_stream`). Requests are sent through
+    `rate_limiter` if it is given, the same limiter can be shared by many models and callers
     """
-    def __init__(self) -> None:
+    def __init__(self, rate_limiter: RateLimiter | None = None) -> None:
         load_dotenv()
+        self.rate_limiter = rate_limiter
+        self.model_name = type(self).__name__
+
+    def _generate(self, prompt: str) -> str:
+        """
+        Provider call, without rate limiting
+        """
         pass
 
+    async def _agenerate(self, prompt: str) -> str:
+        """
+        Asynchronous provider call. By default, the blocking `_generate` is run in the default executor
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self._generate, prompt)
+
+    def _stream(self, prompt: str):
+        """
+        Provider streaming call, yield pieces of the response as they are generated.
+        By default, the whole response of `_generate` is a single piece
+        """
+        yield self._generate(prompt)
+
     def generate(self, prompt: str) -> str:
         """
         Generate LLM's response from `prompt` text
         """
+        if self.rate_limiter is None:
+            return self._generate(prompt)
+
+        return self.rate_limiter.call(self._generate, prompt)
+
+    async def agenerate(self, prompt: str) -> str:
+        """
+        Asynchronous version of `generate`
+        """
+        if self.rate_limiter is None:
+            return await self._agenerate(prompt)
+
+        return await self.rate_limiter.acall(self._agenerate, prompt)
+
+    def __start_stream(self, prompt: str):
+        """
+        Send the request and wait for the first piece, so a rate limit error is raised here and can be retried
+        """
+        pieces = iter(self._stream(prompt))
+        return next(pieces, ""), pieces
+
+    def stream(self, prompt: str):
+        """
+        Yield LLM's response from `prompt` piece by piece, as the model generates it.
+        Only the request itself is retried on rate limit errors, not a stream which has already started
+        """
+        if self.rate_limiter is None:
+            first, pieces = self.__start_stream(prompt)
+        else:
+            first, pieces = self.rate_limiter.call(self.__start_stream, prompt)
+
+        if first:
+            yield first
+        yield from pieces
+
+    def invalidate(self, prompt: str):
+        """
+        Called when the response of `prompt` is rejected by the caller (e.g. incomplete extraction),
+        so a cached response is not returned again. Nothing to do for uncached models
+        """
         pass
 
+    async def agenerate_many(self, prompts: list[str], concurrency: int = 8, return_exceptions: bool = False) -> list:
+        """
+        Generate responses for all `prompts`, at most `concurrency` requests are in flight at the same time.
+        Responses keep the same order as `prompts`
+
+        Parameters
+        -
+        return_exceptions: If true, a failed prompt returns its exception instead of raising it
+        """
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+
+        async def run(prompt: str):
+            async with semaphore:
+                return await self.agenerate(prompt)
+
+        return await asyncio.gather(*[run(prompt) for prompt in prompts], return_exceptions=return_exceptions)
+
+    def generate_many(self, prompts: list[str], concurrency: int = 8, return_exceptions: bool = False) -> list:
+        """
+        Blocking batch generation. Prompts are sent from a thread pool of `concurrency` workers, so it can
+        also be called inside a running event loop (e.g. Jupyter notebook).
+        Responses keep the same order as `prompts`
+
+        Parameters
+        -
+        return_exceptions: If true, a failed prompt returns its exception instead of raising it
+        """
+        if len(prompts) == 0:
+            return []
+
+        def run(prompt: str):
+            try:
+                return self.generate(prompt)
+            except Exception as exp:
+                if return_exceptions:
+                    return exp
+                raise
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(prompts)))) as executor:
+            return list(executor.map(run, prompts))
+
+    def generate_as_completed(self, prompts: list[str], concurrency: int = 8, return_exceptions: bool = False):
+        """
+        Same as `generate_many`, but yield `(index, response)` of each prompt as soon as its response is ready
+        """
+        if len(prompts) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(prompts)))) as executor:
+            futures = {executor.submit(self.generate, prompt): i for i, prompt in enumerate(prompts)}
+
+            for future in as_completed(futures):
+                try:
+                    response = future.result()
+                except Exception as exp:
+                    if not return_exceptions:
+                        raise
+                    response = exp
+
+                yield futures[future], response
+
 
 
 class GeminiModel(LLM):
     """
     Gemini model
     """
-    def __init__(self, model_name="gemini-1.5-flash-001") -> None:
-        super().__init__()
+    def __init__(self, model_name="gemini-1.5-flash-001", rate_limiter: RateLimiter | None = None) -> None:
+        super().__init__(rate_limiter)
         GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
         # Check if api key is valid
         assert GOOGLE_API_KEY
 
         genai.configure(api_key=GOOGLE_API_KEY)
+        self.model_name = model_name
         self.__gen_model = genai.GenerativeModel(model_name)
 
-    def generate(self, prompt: str) -> str:
-        
+    def _generate(self, prompt: str) -> str:
+
         reponse = self.__gen_model.generate_content(prompt)
 
         return reponse.text
-    
+
+    async def _agenerate(self, prompt: str) -> str:
+
+        response = await self.__gen_model.generate_content_async(prompt)
+
+        return response.text
+
+    def _stream(self, prompt: str):
+
+        response = self.__gen_model.generate_content(prompt, stream=True)
+
+        for chunk in response:
+            yield chunk.text
+
 
 
 class OpenAIModel(LLM):
     """
     OpenAI model
     """
-    def __init__(self, model_name="gpt-4o") -> None:
-        super().__init__()
+    def __init__(self, model_name="gpt-4o", rate_limiter: RateLimiter | None = None) -> None:
+        super().__init__(rate_limiter)
         OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
         self.client = OpenAI(api_key=OPENAI_API_KEY)
+        self.async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
         self.model = model_name
+        self.model_name = model_name
 
-    def generate(self, prompt: str) -> str:
+    def _generate(self, prompt: str) -> str:
         response = self.client.chat.completions.create(
             model=self.model,
             messages=[
-                {"content": prompt}
+                {"role": "user", "content": prompt}
             ]
         )
 
-        return response.choices[0].message.content
\ No newline at end of file
+        return response.choices[0].message.content
+
+    async def _agenerate(self, prompt: str) -> str:
+        response = await self.async_client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+        return response.choices[0].message.content
+
+    def _stream(self, prompt: str):
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "user", "content": prompt}
+            ],
+            stream=True
+        )
+
+        for chunk in response:
+            if len(chunk.choices) > 0 and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+
+class FakeModel(LLM):
+    """
+    Deterministic offline model, used to test and benchmark pipelines without any API call.
+
+    The response of a prompt is always the same. If `responses` is given, it is called with the prompt
+    to build the response, otherwise the response is a short digest of the prompt.
+    `latency` (seconds) simulates the network round-trip of a real model. A streamed response is
+    split into pieces of `stream_size` characters.
+    """
+    def __init__(self, responses=None, latency: float = 0.0, rate_limiter: RateLimiter | None = None,
+                 stream_size: int = 16) -> None:
+        super().__init__(rate_limiter)
+        self.responses = responses
+        self.latency = latency
+        self.stream_size = stream_size
+        self.call_count = 0
+        self.model_name = "fake"
+        self.__lock = threading.Lock()
+
+    def __response(self, prompt: str) -> str:
+        # Called from the worker threads of `generate_as_completed`
+        with self.__lock:
+            self.call_count += 1
+
+        if self.responses is not None:
+            return self.responses(prompt)
+
+        return "FAKE-" + hashlib.sha256(prompt.encode()).hexdigest()[:16]
+
+    def _generate(self, prompt: str) -> str:
+        time.sleep(self.latency)
+        return self.__response(prompt)
+
+    async def _agenerate(self, prompt: str) -> str:
+        await asyncio.sleep(self.latency)
+        return self.__response(prompt)
+
+    def _stream(self, prompt: str):
+        time.sleep(self.latency)
+        response = self.__response(prompt)
+
+        for i in range(0, len(response), self.stream_size):
+            yield response[i:i + self.stream_size]
+
+
+
+class CachedLLM(LLM):
+    """
+    Wrap `llm` with a response cache. Responses are keyed by hash of model name and prompt,
+    so identical prompts are only sent once across runs. Cache hits skip the rate limiter of `llm`
+    """
+    def __init__(self, llm: LLM, cache: ResponseCache) -> None:
+        super().__init__()
+        self.llm = llm
+        self.cache = cache
+        self.model_name = llm.model_name
+
+    def __key(self, prompt: str) -> str:
+        return hash_text(self.model_name, prompt)
+
+    def generate(self, prompt: str) -> str:
+        key = self.__key(prompt)
+        response = self.cache.get(key)
+        if response is None:
+            response = self.llm.generate(prompt)
+            self.cache.put(key, response)
+
+        return response
+
+    async def agenerate(self, prompt: str) -> str:
+        key = self.__key(prompt)
+        response = self.cache.get(key)
+        if response is None:
+            response = await self.llm.agenerate(prompt)
+            self.cache.put(key, response)
+
+        return response
+
+    def stream(self, prompt: str):
+        """
+        Yield cached response as a single piece, otherwise stream from `llm`. A streamed response is cached
+        once it has been fully read
+        """
+        key = self.__key(prompt)
+        response = self.cache.get(key)
+        if response is not None:
+            yield response
+            return
+
+        pieces = []
+        for piece in self.llm.stream(prompt):
+            pieces.append(piece)
+            yield piece
+
+        self.cache.put(key, ''.join(pieces))
+
+    def invalidate(self, prompt: str):
+        self.cache.delete(self.__key(prompt))
+        self.llm.invalidate(prompt)
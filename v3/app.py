@@ -1,64 +1,143 @@
-import os
-from langchain_community.graphs import Neo4jGraph
+from neo4j_pool import Neo4jPool, get_pool
 import LLM, EmbeddingModel
 from LLM import GeminiModel
 from EmbeddingModel import GeminiEmbeddingModel
 import cypher_query as cq
+from vector_index import VectorIndex, search_communities
+from context_packer import ContextPacker
+from relevance_gate import RelevanceGate
 from prompts import community_answer_prompts, global_answer_prompts
 
 class App:
-    def __init__(self, llm: LLM, em: EmbeddingModel):
+    def __init__(self, llm: LLM, em: EmbeddingModel, pool: Neo4jPool | None = None, index: VectorIndex | None = None,
+                 vector_index: str = "christmas_carol", packer: ContextPacker | None = None,
+                 gate: RelevanceGate | None = None):
+        """
+        Parameters
+        -
+        vector_index: name of Neo4j vector index of community summaries
+
+        pool: Neo4j connection pool. If None, the process-wide shared pool is used
+
+        index: In-process community index (see `vector_index.load_community_index`). If given, communities
+        are retrieved from it instead of Neo4j vector index, and no database is needed unless `pool` is given
+
+        packer: If given, each community report sent to the model is packed into its token budget
+        (summary, then as many findings as fit)
+
+        gate: If given, retrieved communities are filtered by score and rating before any of them is sent to
+        the model. Otherwise the 20 closest communities are answered
+        """
+        self.__kg = None
+        self.__index = index
+
         # Connect to database
-        
-        NEO4J_URL = os.getenv('NEO4J_URL')
-        NEO4J_USERNAME = os.getenv('NEO4J_USERNAME')
-        NEO4J_PASSWORD = os.getenv('NEO4J_PASSWORD')
-        NEO4J_DATABASE = os.getenv('NEO4J_DATABASE')
-
-        print("Connecting to Database...")
-        try:
-            self.__kg = Neo4jGraph(NEO4J_URL, NEO4J_USERNAME, NEO4J_PASSWORD, NEO4J_DATABASE)
-            print("Connect successfully!")
-        except:
-            raise NameError("Can not connect to Database")
+        if index is None or pool is not None:
+            print("Connecting to Database...")
+            try:
+                self.__kg = pool if pool is not None else get_pool()
+                self.__kg.verify()
+                print("Connect successfully!")
+            except:
+                raise NameError("Can not connect to Database")
 
         self.__llm = llm
         self.__gem = em
-        self.__vector_index = "christmas_carol"
-
-    def get_answers(self, query: str, communities):
-        """
-        Collect answers from relevant communities
-        """
-        answers = []
+        self.__vector_index = vector_index
+        self.__packer = packer
+        self.__gate = gate
 
+    def __create_answer_prompts(self, query: str, communities) -> list[str]:
+        prompts = []
         for community in communities:
             summary, findings = community[1], community[4]
-            prompt = community_answer_prompts.get_prompts(query, [summary, findings])
-            
-            try:
-                answer = self.__llm.generate(prompt)
-            except Exception as exp:
-                print(f"Error counter: {exp} \n")
-                continue
+            info = [summary, findings] if self.__packer is None else self.__packer.pack_report(summary, findings)
+            prompts.append(community_answer_prompts.get_prompts(query, info))
 
-            # Filter answer
-            if answer.find("<UNKNOWN>") != -1:
-                continue
+        return prompts
+
+    @staticmethod
+    def __is_answer(answer) -> bool:
+        if isinstance(answer, Exception):
+            print(f"Error counter: {answer} \n")
+            return False
 
-            answers.append(answer)
+        # Filter answer
+        return answer.find("<UNKNOWN>") == -1
 
-        return answers
+    def get_answers(self, query: str, communities, max_workers: int = 8):
+        """
+        Collect answers from relevant communities. Communities are answered concurrently,
+        at most `max_workers` LLM calls are in flight at the same time.
+
+        The answers keep the same order as `communities`
+        """
+        prompts = self.__create_answer_prompts(query, communities)
+        answers = self.__llm.generate_many(prompts, concurrency=max_workers, return_exceptions=True)
 
+        return [answer for answer in answers if self.__is_answer(answer)]
 
 
-    def generate(self, query: str):
+
+    def search(self, query: str, level: int | None = None):
+        """
+        Return communities relevant to `query`, closest first
+        """
         embedding_query = self.__gem.embed(query)
-        communities = cq.get_search_result(self.__kg, self.__vector_index, 20, embedding_query)
+        result_number = self.__gate.max_k if self.__gate is not None else 20
+
+        if self.__index is not None:
+            communities = search_communities(self.__index, result_number, embedding_query, level)
+        else:
+            communities = cq.get_search_result(self.__kg, self.__vector_index, result_number, embedding_query, level)
+
+        if self.__gate is None:
+            return communities
+
+        relevant = self.__gate.filter(communities)
+        print(f"Relevant communities: {len(relevant)}/{len(communities)}")
+        return relevant
+
+
+
+    def generate(self, query: str, max_workers: int = 8, level: int | None = None):
+        """
+        Answer `query` from the closest communities
+
+        Parameters
+        -
+        level: community level to search (see `CommunityExtractor.extract`). Level 0 has the fewest and largest
+        communities, which is enough for broad questions and needs fewer LLM calls. None searches every level
+        """
+        communities = self.search(query, level)
         
-        answers = self.get_answers(query, communities)
+        answers = self.get_answers(query, communities, max_workers)
 
         prompt = global_answer_prompts.get_prompts(answers)
         global_answer = self.__llm.generate(prompt)
 
-        return global_answer
\ No newline at end of file
+        return global_answer
+
+
+
+    def stream(self, query: str, max_workers: int = 8, level: int | None = None):
+        """
+        Streaming version of `generate`. Yield `("community", answer)` for each community answer as soon as it
+        is ready, then `("global", piece)` for each piece of the global answer as the model generates it.
+
+        The global answer is built from community answers in the same order as `generate`
+        """
+        communities = self.search(query, level)
+        prompts = self.__create_answer_prompts(query, communities)
+
+        answers = [None] * len(prompts)
+        for i, answer in self.__llm.generate_as_completed(prompts, concurrency=max_workers, return_exceptions=True):
+            if not self.__is_answer(answer):
+                continue
+
+            answers[i] = answer
+            yield "community", answer
+
+        prompt = global_answer_prompts.get_prompts([answer for answer in answers if answer is not None])
+        for piece in self.__llm.stream(prompt):
+            yield "global", piece
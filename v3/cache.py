@@ -0,0 +1,281 @@
+"""Persistent caches of LLM responses and embedding vectors"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+
+class ResponseCache:
+    """
+    Two level key-value cache: in-memory LRU in front of a SQLite file.
+
+    Parameters
+    -
+    path: SQLite file path. If None, only the in-memory level is used
+
+    memory_size: maximum number of entries kept in memory
+
+    max_entries: maximum number of entries kept on disk, least recently used entries are evicted. None means unlimited
+
+    ttl: time to live of an entry (seconds). None means entries never expire
+    """
+    def __init__(self, path: str | None = None, memory_size: int = 1024, max_entries: int | None = None, ttl: float | None = None):
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        # key -> (value, created time)
+        self.__memory: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__db = None
+
+        if path is not None:
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+            self.__db = sqlite3.connect(path, check_same_thread=False)
+            self.__db.execute("PRAGMA journal_mode=WAL")
+            self.__db.execute("""
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+)
+""")
+            self.__db.commit()
+
+    def __expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def __remember(self, key: str, value: str, created: float):
+        self.__memory[key] = (value, created)
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.memory_size:
+            self.__memory.popitem(last=False)
+
+    def get(self, key: str):
+        """
+        Return cached value of `key`, or None if it is missing or expired
+        """
+        with self.__lock:
+            if key in self.__memory:
+                value, created = self.__memory[key]
+                if not self.__expired(created):
+                    self.__memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+
+                del self.__memory[key]
+
+            if self.__db is not None:
+                row = self.__db.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self.__expired(row[1]):
+                    self.__db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (time.time(), key))
+                    self.__db.commit()
+                    self.__remember(key, row[0], row[1])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: str):
+        now = time.time()
+
+        with self.__lock:
+            self.__remember(key, value, now)
+
+            if self.__db is not None:
+                self.__db.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                    (key, value, now, now)
+                )
+                self.__evict()
+                self.__db.commit()
+
+    def delete(self, key: str):
+        with self.__lock:
+            self.__memory.pop(key, None)
+
+            if self.__db is not None:
+                self.__db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.__db.commit()
+
+    def __evict(self):
+        """
+        Remove expired entries and least recently used entries over `max_entries` from disk
+        """
+        if self.ttl is not None:
+            self.__db.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+
+        if self.max_entries is not None:
+            self.__db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def stats(self) -> dict:
+        """
+        Return hit/miss counters
+        """
+        with self.__lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "memory_entries": len(self.__memory),
+            }
+
+    def close(self):
+        with self.__lock:
+            if self.__db is not None:
+                self.__db.close()
+                self.__db = None
+
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embedding vectors stored in `folder`:
+
+    - vectors.f32: float32 matrix, one row per vector, memory-mapped when read
+    - keys.txt: key of each row, one per line
+    - meta.json: vector dimension
+
+    Both files are only appended. Vectors are written before keys, and on open both files are cut to the
+    rows which have a vector and a complete key, so an interrupted write never maps a key to another row.
+    """
+    def __init__(self, folder: str):
+        os.makedirs(folder, exist_ok=True)
+
+        self.__vector_path = os.path.join(folder, "vectors.f32")
+        self.__key_path = os.path.join(folder, "keys.txt")
+        self.__meta_path = os.path.join(folder, "meta.json")
+
+        self.hits = 0
+        self.misses = 0
+        self.dim = None
+
+        self.__rows: dict[str, int] = {}
+        self.__matrix = None
+        self.__lock = threading.Lock()
+
+        if os.path.exists(self.__meta_path):
+            with open(self.__meta_path, 'r') as fp:
+                self.dim = json.load(fp)["dim"]
+
+            self.__recover()
+
+    def __recover(self):
+        """
+        Load keys and cut both files to the rows which have a vector and a complete key, so rows written
+        after an interrupted write are appended at the right place
+        """
+        content = ""
+        if os.path.exists(self.__key_path):
+            with open(self.__key_path, 'r') as fp:
+                content = fp.read()
+
+        # Last line without line break is a partially written key
+        keys = content.split("\n")[:-1]
+
+        row_size = 4 * self.dim
+        vector_rows = os.path.getsize(self.__vector_path) // row_size if os.path.exists(self.__vector_path) else 0
+        row_count = min(len(keys), vector_rows)
+
+        with open(self.__vector_path, 'ab') as fp:
+            fp.truncate(row_count * row_size)
+
+        kept = "".join(key + "\n" for key in keys[:row_count])
+        if kept != content:
+            with open(self.__key_path, 'w') as fp:
+                fp.write(kept)
+
+        for row, key in enumerate(keys[:row_count]):
+            self.__rows[key] = row
+
+    def __len__(self):
+        return len(self.__rows)
+
+    def __view(self):
+        """
+        Return memory-mapped matrix of all stored vectors, remap if the file has grown
+        """
+        count = len(self.__rows)
+        if self.__matrix is None or self.__matrix.shape[0] < count:
+            self.__matrix = np.memmap(self.__vector_path, dtype=np.float32, mode='r', shape=(count, self.dim))
+
+        return self.__matrix
+
+    def get_many(self, keys: list[str]) -> list:
+        """
+        Return cached vector of each key, None for missing keys
+        """
+        with self.__lock:
+            rows = [self.__rows.get(key) for key in keys]
+            found = [row for row in rows if row is not None]
+            self.hits += len(found)
+            self.misses += len(rows) - len(found)
+
+            if len(found) == 0:
+                return [None] * len(keys)
+
+            matrix = self.__view()
+            return [None if row is None else np.array(matrix[row]) for row in rows]
+
+    def get(self, key: str):
+        return self.get_many([key])[0]
+
+    def put_many(self, keys: list[str], vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(keys) == 0:
+            return
+
+        assert vectors.shape[0] == len(keys)
+
+        with self.__lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self.__meta_path, 'w') as fp:
+                    json.dump({"dim": self.dim}, fp)
+
+            assert vectors.shape[1] == self.dim
+
+            # Skip keys which are already stored or repeated in the batch
+            new, seen = [], set()
+            for i, key in enumerate(keys):
+                if key not in self.__rows and key not in seen:
+                    new.append(i)
+                    seen.add(key)
+            if len(new) == 0:
+                return
+
+            with open(self.__vector_path, 'ab') as fp:
+                fp.write(np.ascontiguousarray(vectors[new]).tobytes())
+
+            with open(self.__key_path, 'a') as fp:
+                for i in new:
+                    self.__rows[keys[i]] = len(self.__rows)
+                    fp.write(keys[i] + "\n")
+
+    def put(self, key: str, vector):
+        self.put_many([key], [vector])
+
+    def stats(self) -> dict:
+        with self.__lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "entries": len(self.__rows),
+            }
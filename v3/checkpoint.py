@@ -0,0 +1,94 @@
+"""Append-only checkpoint store of completed indexing units"""
+
+import os
+import json
+import hashlib
+import threading
+
+def hash_text(*parts: str) -> str:
+    """
+    Return sha256 digest of `parts`
+    """
+    sha = hashlib.sha256()
+    for part in parts:
+        sha.update(part.encode())
+        sha.update(b"\0")
+
+    return sha.hexdigest()
+
+
+class CheckpointStore:
+    """
+    Store the result of each completed unit of work (chunk extraction, key summarization, community
+    summarization) in a JSONL file. Each line is a record:
+
+    {"stage": stage, "key": key, "value": value}
+
+    The file is only appended, so a crash loses at most the unit in progress. When the store is opened
+    again, the finished units are loaded and can be skipped.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.__records: dict[tuple[str, str], object] = {}
+        self.__lock = threading.Lock()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        if os.path.exists(path):
+            self.__truncate_partial_line(path)
+
+            with open(path, 'r') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+
+                    self.__records[(record["stage"], record["key"])] = record["value"]
+
+        self.__fp = open(path, 'a')
+
+    @staticmethod
+    def __truncate_partial_line(path: str):
+        """
+        Cut the file after its last line break. The last line is incomplete if the process was killed
+        while writing, the next record would be appended to it and both would be lost
+        """
+        with open(path, 'rb+') as fp:
+            data = fp.read()
+            if len(data) == 0 or data.endswith(b"\n"):
+                return
+
+            fp.truncate(data.rfind(b"\n") + 1)
+
+    def __len__(self):
+        return len(self.__records)
+
+    def has(self, stage: str, key: str) -> bool:
+        return (stage, key) in self.__records
+
+    def get(self, stage: str, key: str, default=None):
+        return self.__records.get((stage, key), default)
+
+    def put(self, stage: str, key: str, value):
+        """
+        Record a completed unit. `value` must be JSON serializable
+        """
+        line = json.dumps({"stage": stage, "key": key, "value": value})
+
+        with self.__lock:
+            self.__records[(stage, key)] = value
+            self.__fp.write(line + "\n")
+            self.__fp.flush()
+
+    def count(self, stage: str) -> int:
+        """
+        Return number of completed units of `stage`
+        """
+        return sum(1 for record_stage, _ in self.__records if record_stage == stage)
+
+    def close(self):
+        with self.__lock:
+            self.__fp.close()
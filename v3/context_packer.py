@@ -0,0 +1,145 @@
+"""Fit community context into a token budget before it is sent to the model"""
+
+import json
+import tiktoken
+
+class ContextPacker:
+    """
+    Select the most important part of a community context which fits in `max_tokens` tokens.
+    Tokens are counted with tiktoken, each line of the context costs its tokens plus one for the line break.
+
+    - Community content: relationships are ranked by degree of both ends (`rank`) and added with their entities,
+    then the remaining entities by degree
+    - Sub-community reports: ranked by rating
+    - Community report of an answer: summary first, then findings in their order
+
+    Parameters
+    -
+    max_tokens: token budget of the context (the prompt template is not counted)
+
+    encoding_name: tiktoken encoding used to count tokens
+    """
+    def __init__(self, max_tokens: int = 8000, encoding_name: str = "cl100k_base"):
+        self.max_tokens = max_tokens
+        self.tokenizer = tiktoken.get_encoding(encoding_name)
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, disallowed_special=()))
+
+    def __cost(self, line: str) -> int:
+        return self.count_tokens(line) + 1
+
+    def pack_community(self, entities: list, relationships: list) -> tuple[list[str], list[str], bool]:
+        """
+        Pack a community given as `entities` (`[name, description, degree]`) and `relationships`
+        (`[source, target, description, rank]`), the records of `cypher_query.stream_community_context`.
+
+        Return `(entity_info, relationship_info, complete)` formatted for community summarize prompt,
+        `complete` is False if some entities or relationships did not fit
+        """
+        budget = self.max_tokens
+        entity_lines = {name: f"{name},{description}" for name, description, _ in entities}
+        entity_info, relationship_info = [], []
+        added = set()
+
+        # Most connected relationships first, each with the entities it links
+        for source, target, description, _ in sorted(relationships, key=lambda rel: (-rel[3], rel[0], rel[1])):
+            lines = [entity_lines[name] for name in dict.fromkeys((source, target)) if name in entity_lines and name not in added]
+            relationship = f"{source},{target},{description}"
+            cost = sum(self.__cost(line) for line in lines) + self.__cost(relationship)
+            if cost > budget:
+                break
+
+            budget -= cost
+            entity_info.extend(lines)
+            added.update(name for name in (source, target) if name in entity_lines)
+            relationship_info.append(relationship)
+
+        # Entities without any packed relationship
+        for name, _, _ in sorted(entities, key=lambda entity: (-entity[2], entity[0])):
+            if name in added:
+                continue
+
+            cost = self.__cost(entity_lines[name])
+            if cost > budget:
+                break
+
+            budget -= cost
+            entity_info.append(entity_lines[name])
+            added.add(name)
+
+        # Keep at least the most connected entity, truncated to the budget
+        if len(entity_info) == 0 and len(entities) > 0:
+            name = sorted(entities, key=lambda entity: (-entity[2], entity[0]))[0][0]
+            entity_info.append(self.truncate(entity_lines[name], self.max_tokens - 1))
+
+        complete = len(added) == len(entity_lines) and len(relationship_info) == len(relationships)
+        return entity_info, relationship_info, complete
+
+    def pack_sub_communities(self, sub_communities: list, relationships: list) -> tuple[list[str], list[str]]:
+        """
+        Pack reports of sub-communities (`[title, summary, rating]`) by rating, then relationships between
+        sub-communities (`[source, target, description, rank]`) by rank in the remaining budget.
+
+        Return `(sub_community_info, relationship_info)` formatted for community summarize prompt
+        """
+        budget = self.max_tokens
+        sub_community_info, relationship_info = [], []
+
+        for title, summary, _ in sorted(sub_communities, key=lambda sub: (-(sub[2] or 0), sub[0])):
+            line = f"{title},{summary}"
+            cost = self.__cost(line)
+            if cost > budget:
+                break
+
+            budget -= cost
+            sub_community_info.append(line)
+
+        for source, target, description, _ in sorted(relationships, key=lambda rel: (-rel[3], rel[0], rel[1])):
+            line = f"{source},{target},{description}"
+            cost = self.__cost(line)
+            if cost > budget:
+                break
+
+            budget -= cost
+            relationship_info.append(line)
+
+        return sub_community_info, relationship_info
+
+    def pack_report(self, summary: str, findings: str) -> list:
+        """
+        Pack a community report for community answer prompt: `[summary, findings]`, where `findings` (JSON list
+        stored in community node) keeps as many findings as fit after the summary
+        """
+        budget = self.max_tokens - self.__cost(summary)
+        if budget <= 0:
+            return [self.truncate(summary, self.max_tokens), "[]"]
+
+        try:
+            items = json.loads(findings)
+        except (TypeError, ValueError):
+            return [summary, self.truncate(findings or "", budget)]
+
+        if not isinstance(items, list):
+            return [summary, self.truncate(findings, budget)]
+
+        packed = []
+        for item in items:
+            cost = self.__cost(json.dumps(item))
+            if cost > budget:
+                break
+
+            budget -= cost
+            packed.append(item)
+
+        return [summary, json.dumps(packed)]
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """
+        Keep the first `max_tokens` tokens of `text`
+        """
+        tokens = self.tokenizer.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+
+        return self.tokenizer.decode(tokens[:max(0, max_tokens)])
@@ -0,0 +1,93 @@
+"""Ingest a corpus of many documents into one graph"""
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from text_splitter import TextSplitter
+
+from common.text_normalize import normalize_text
+
+def load_manifest(source: str) -> list[dict]:
+    """
+    Return list of `{doc_id, path}` documents from `source`:
+
+    - a directory: every .txt file, `doc_id` is the file name without extension
+    - a .json manifest: list of `{"doc_id", "path"}` objects, relative paths are resolved from the manifest folder
+    """
+    if os.path.isdir(source):
+        return [
+            {"doc_id": os.path.splitext(name)[0], "path": os.path.join(source, name)}
+            for name in sorted(os.listdir(source)) if name.endswith(".txt")
+        ]
+
+    with open(source, 'r') as fp:
+        documents = json.load(fp)
+
+    folder = os.path.dirname(os.path.abspath(source))
+    return [
+        {"doc_id": document["doc_id"], "path": os.path.join(folder, document["path"])}
+        for document in documents
+    ]
+
+
+def split_document(document: dict, chunk_size: int, chunk_overlap: int, encoding_name: str = "cl100k_base") -> list[dict]:
+    """
+    Read, normalize and split a document. Return list of `{doc_id, chunk_id, text}` chunks.
+    Runs in a worker process
+    """
+    with open(document["path"], 'r', encoding='utf-8') as fp:
+        text = normalize_text(fp.read())
+
+    text_splitter = TextSplitter(chunk_size, chunk_overlap, encoding_name)
+    doc_id = document["doc_id"]
+
+    return [
+        {"doc_id": doc_id, "chunk_id": f"{doc_id}-chunk-{i:04d}", "text": text[span.start_char:span.end_char]}
+        for i, span in enumerate(text_splitter.split_spans(text))
+    ]
+
+
+def iter_corpus_chunks(documents: list[dict], chunk_size: int = 600, chunk_overlap: int = 20, processes: int | None = None):
+    """
+    Split `documents` in a process pool and yield chunks of each document as soon as it is split
+    """
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {
+            executor.submit(split_document, document, chunk_size, chunk_overlap): document for document in documents
+        }
+
+        for future in as_completed(futures):
+            document = futures[future]
+            try:
+                chunks = future.result()
+            except Exception as error:
+                print(f"Failed to split document {document['doc_id']}: {error}\n")
+                continue
+
+            print(f"Document {document['doc_id']}: {len(chunks)} chunks")
+            yield from chunks
+
+
+def ingest_corpus(source: str, extractor, chunk_size: int = 600, chunk_overlap: int = 20,
+                  processes: int | None = None, workers: int = 8, attempt_limit: int = 5):
+    """
+    Extract *entities* and *relationship* of every document of `source` (directory or manifest) with
+    `extractor` (`GraphExtractor`). Documents are split in `processes` worker processes, and their chunks
+    feed the extraction queue of `workers` concurrent LLM calls while other documents are still being split.
+
+    Entities and relationships are tagged with the id of the documents they were found in.
+    Return list of chunks `{doc_id, chunk_id, text}`, failed chunks are listed in `extractor.failed_chunks`
+    """
+    documents = load_manifest(source)
+    print(f"Corpus: {len(documents)} documents")
+
+    chunks = []
+
+    def queue_chunks():
+        for chunk in iter_corpus_chunks(documents, chunk_size, chunk_overlap, processes):
+            chunks.append(chunk)
+            yield chunk
+
+    extractor.extract_many(queue_chunks(), workers=workers, attempt_limit=attempt_limit)
+
+    return chunks
@@ -1,139 +1,397 @@
 from langchain_community.graphs import Neo4jGraph
-
-def convert_quote(text: str) -> str:
-    return text.replace("'", "\\'").replace('"', '\\"')
+from neo4j_pool import Neo4jPool
 
 def convert2normal(text: str) -> str:
     return text.lower().capitalize()
 
-def create_entity(kg: Neo4jGraph, entity_name: str, entity_type: str, description: str):
+def create_entity(kg: Neo4jGraph | Neo4jPool, entity_name: str, entity_type: str, description: str):
     """
     Create entity and entity type node (if not exist) node in Neo4j db
     """
 
-    entity_name = convert_quote(entity_name)
-    entity_type = convert2normal(convert_quote(entity_type))
-    description = convert_quote(description)
+    entity_type = convert2normal(entity_type)
+
+    # Label can not be a parameter
+    label = entity_type.replace("`", "``")
 
     query = f"""
-MERGE(et:{entity_type} {{type: '{entity_type}'}})
-MERGE(e:Entity {{name: '{entity_name}'}})
-SET e.description = '{description}'
+MERGE(et:`{label}` {{type: $entity_type}})
+MERGE(e:Entity {{name: $entity_name}})
+SET e.description = $description
 MERGE(e)-[:TYPE]->(et)
 """
-    return kg.query(query)
+    return kg.query(query, params={"entity_name": entity_name, "entity_type": entity_type, "description": description})
 
 
-def create_relationship(kg: Neo4jGraph, source_entity: str, target_entity: str, description: str):
+def create_relationship(kg: Neo4jGraph | Neo4jPool, source_entity: str, target_entity: str, description: str):
     """
     Create relationships between 2 entities. Entities are created if not exist
     """
-    source_entity = convert_quote(source_entity)
-    target_entity = convert_quote(target_entity)
-    description = convert_quote(description)
-
-    query = f"""
-MERGE(e1:Entity {{name: '{source_entity}'}})
-MERGE(e2:Entity {{name: '{target_entity}'}})
+    query = """
+MERGE(e1:Entity {name: $source_entity})
+MERGE(e2:Entity {name: $target_entity})
 MERGE(e1)-[r:RELATED]->(e2)
-SET r.description = '{description}'
+SET r.description = $description
 """
     
-    return kg.query(query)
+    return kg.query(query, params={"source_entity": source_entity, "target_entity": target_entity, "description": description})
+
+
+def _write_batches(kg: Neo4jGraph | Neo4jPool, query: str, rows: list[dict], batch_size: int, **params):
+    """
+    Run `query` with `rows` bound to `$rows`, `batch_size` rows per explicit write transaction
+    """
+    def write(tx, batch):
+        tx.run(query, rows=batch, **params).consume()
+
+    if isinstance(kg, Neo4jPool):
+        session = kg.session(write=True)
+    else:
+        session = kg._driver.session(database=kg._database)
+
+    with session:
+        for i in range(0, len(rows), batch_size):
+            session.execute_write(write, rows[i:i + batch_size])
+
+
+def create_entities_bulk(kg: Neo4jGraph | Neo4jPool, entities: list[dict], batch_size: int = 1000):
+    """
+    Create entity and entity type nodes from list of `{entity_name, entity_type, description, doc_ids}` objects
+    (the format of `GraphExtractor.data`), using one `UNWIND` query per batch. `doc_ids` are added to
+    the document ids already stored in the entity
+    """
+    # Label can not be a parameter, so entities are grouped by entity type
+    groups: dict[str, list[dict]] = {}
+    for entity in entities:
+        entity_type = convert2normal(entity["entity_type"])
+        groups.setdefault(entity_type, []).append({
+            "entity_name": entity["entity_name"],
+            "description": entity["description"],
+            "doc_ids": entity.get("doc_ids", [])
+        })
+
+    for entity_type, rows in groups.items():
+        label = entity_type.replace("`", "``")
+        query = f"""
+UNWIND $rows AS row
+MERGE(et:`{label}` {{type: $entity_type}})
+MERGE(e:Entity {{name: row.entity_name}})
+SET e.description = row.description,
+    e.doc_ids = coalesce(e.doc_ids, []) + [d IN row.doc_ids WHERE NOT d IN coalesce(e.doc_ids, [])]
+MERGE(e)-[:TYPE]->(et)
+"""
+        _write_batches(kg, query, rows, batch_size, entity_type=entity_type)
+
+
+def create_relationships_bulk(kg: Neo4jGraph | Neo4jPool, relationships: list[dict], batch_size: int = 1000):
+    """
+    Create relationships from list of `{source_entity, target_entity, description, doc_ids}` objects
+    (the format of `GraphExtractor.data`), using one `UNWIND` query per batch. Entities are created if not exist
+    """
+    query = """
+UNWIND $rows AS row
+MERGE(e1:Entity {name: row.source_entity})
+MERGE(e2:Entity {name: row.target_entity})
+MERGE(e1)-[r:RELATED]->(e2)
+SET r.description = row.description,
+    r.doc_ids = coalesce(r.doc_ids, []) + [d IN row.doc_ids WHERE NOT d IN coalesce(r.doc_ids, [])]
+"""
+    rows = [{
+        "source_entity": relationship["source_entity"],
+        "target_entity": relationship["target_entity"],
+        "description": relationship["description"],
+        "doc_ids": relationship.get("doc_ids", [])
+    } for relationship in relationships]
+
+    _write_batches(kg, query, rows, batch_size)
+
+
+def _read(kg: Neo4jGraph | Neo4jPool, query: str, params: dict | None = None) -> list[dict]:
+    """
+    Run read-only `query`, it is routed to a reader when `kg` is a `Neo4jPool`
+    """
+    if isinstance(kg, Neo4jPool):
+        return kg.read(query, params)
+
+    return kg.query(query, params=params or {})
 
 
-def drop_projected_graph(kg: Neo4jGraph, graph_name: str):
+def _stream(kg: Neo4jGraph | Neo4jPool, query: str, params: dict | None = None):
+    """
+    Yield records of read-only `query` as they arrive when `kg` is a `Neo4jPool`, otherwise from the full result
+    """
+    if isinstance(kg, Neo4jPool):
+        yield from kg.stream(query, params)
+    else:
+        yield from kg.query(query, params=params or {})
+
+
+def drop_projected_graph(kg: Neo4jGraph | Neo4jPool, graph_name: str):
     """
     Drop projected graph from db
     """
-    query = f"""
-CALL gds.graph.drop("{graph_name}", false)
+    query = """
+CALL gds.graph.drop($graph_name, false)
 """
-    return kg.query(query)
+    return kg.query(query, params={"graph_name": graph_name})
 
 
 
-def create_projected_graph(kg: Neo4jGraph, graph_name: str):
+def create_projected_graph(kg: Neo4jGraph | Neo4jPool, graph_name: str):
     """
     Create projected graph and store in-memory db
     """
-    query = f"""
+    query = """
 MATCH (e1: Entity)-[r:RELATED]->(e2: Entity)
 CALL gds.graph.project(
-    "{graph_name}",
+    $graph_name,
     e1,
     e2,
-    {{}},
-    {{
+    {},
+    {
         undirectedRelationshipTypes: ['*']
-    }}
+    }
 )
 """
-    return kg.query(query)
+    return kg.query(query, params={"graph_name": graph_name})
+
+
+
+def create_entity_projection(kg: Neo4jGraph | Neo4jPool, graph_name: str, node_properties: list[str] | None = None):
+    """
+    Project `Entity` nodes and undirected `RELATED` relationships into in-memory graph `graph_name`,
+    with numeric `node_properties` (e.g. `seedCommunityId` to seed Leiden)
+    """
+    query = """
+CALL gds.graph.project(
+    $graph_name,
+    {Entity: {properties: $node_properties}},
+    {RELATED: {orientation: "UNDIRECTED"}}
+)
+YIELD nodeCount, relationshipCount
+RETURN nodeCount, relationshipCount
+"""
+    return kg.query(query, params={"graph_name": graph_name, "node_properties": node_properties or []})
 
 
 
-def create_graph_embedding(kg: Neo4jGraph, graph_name: str, d_embed: int = 128):
+def create_graph_embedding(kg: Neo4jGraph | Neo4jPool, graph_name: str, d_embed: int = 128):
     """
     Using Node2Vec algorithm to embed `graph_name`
     """
-    query = f"""
+    query = """
 CALL gds.node2vec.write(
-    "{graph_name}",
-    {{
+    $graph_name,
+    {
         writeProperty: "embedding",
-        embeddingDimension: {d_embed}
-    }}
+        embeddingDimension: $d_embed
+    }
 )
 """
-    return kg.query(query)
+    return kg.query(query, params={"graph_name": graph_name, "d_embed": d_embed})
 
 
 
-def generate_communities(kg: Neo4jGraph, graph_name: str):
+def generate_communities(kg: Neo4jGraph | Neo4jPool, graph_name: str, seed_property: str | None = None,
+                         include_intermediate: bool = False):
     """
-    Using Leiden algorithm to generate a hierarchy of entity communities
+    Using Leiden algorithm to generate a hierarchy of entity communities.
+
+    Each entity gets `communityIds`, its community at every level from the top (level 0, largest communities)
+    down to the bottom level, `communityId`, its top level community, and `seedCommunityId`, its bottom level
+    community. Leiden builds its first level from the seed, so incremental runs are seeded from the bottom level.
+    Queries fall back to `[communityId]` for entities without `communityIds` (graphs detected with
+    a plain `gds.leiden.write`), which have a single level.
+
+    Parameters
+    -
+    seed_property: node property of the projected graph used as initial communities, so existing
+    community ids are kept where the graph has not changed
+
+    include_intermediate: If True, communities of every Leiden level are kept. Otherwise there is a single level
     """
-    query = f"""
-CALL gds.leiden.write(
-    "{graph_name}",
-    {{
-        writeProperty: "communityId"
-    }}
-)
+    config = {"writeProperty": "communityIds" if include_intermediate else "communityId"}
+    if include_intermediate:
+        config["includeIntermediateCommunities"] = True
+    if seed_property is not None:
+        config["seedProperty"] = seed_property
+
+    query = """
+CALL gds.leiden.write($graph_name, $config)
 YIELD communityCount, modularity, modularities
 """
     
+    result = kg.query(query, params={"graph_name": graph_name, "config": config})
+
+    # Leiden lists intermediate communities from the bottom level up, they are stored top level first
+    if include_intermediate:
+        query = """
+MATCH (e:Entity)
+WHERE e.communityIds IS NOT NULL
+WITH e, reverse(e.communityIds) AS ids
+SET e.communityIds = ids, e.communityId = ids[0], e.seedCommunityId = ids[-1]
+"""
+    else:
+        query = """
+MATCH (e:Entity)
+WHERE e.communityId IS NOT NULL
+SET e.communityIds = [e.communityId], e.seedCommunityId = e.communityId
+"""
+    kg.query(query)
+
+    return result
+
+
+def seed_new_entities(kg: Neo4jGraph | Neo4jPool):
+    """
+    Set `seedCommunityId` of every entity, so every node has a seed for Leiden. Entities of graphs detected
+    before `seedCommunityId` existed are seeded with their bottom level community, entities without community
+    (added since last community detection) get a new unique community id
+    """
+    query = """
+MATCH (e:Entity)
+WHERE e.seedCommunityId IS NULL AND e.communityId IS NOT NULL
+SET e.seedCommunityId = coalesce(e.communityIds, [e.communityId])[-1]
+"""
+    kg.query(query)
+
+    query = """
+MATCH (e:Entity)
+WITH coalesce(max(e.seedCommunityId), -1) AS base
+MATCH (n:Entity)
+WHERE n.seedCommunityId IS NULL
+SET n.seedCommunityId = base + 1 + id(n)
+"""
     return kg.query(query)
 
 
-def create_community(kg: Neo4jGraph, community_id: int, title: str, summary: str, rating: float, rating_explanation: str, findings: str, embedding):
+def delete_communities(kg: Neo4jGraph | Neo4jPool, communities: list[tuple[int, int]]):
     """
-    Create community node
+    Delete community nodes (and their relationships) of `communities`, given as `(level, community_id)` pairs
     """
-    title = convert_quote(title)
-    summary = convert_quote(summary)
-    rating_explanation = convert_quote(rating_explanation)
-    findings = convert_quote(findings)
-    
-    query = f"""
+    query = """
+UNWIND $communities AS key
+MATCH (c:Community {level: key[0], id: key[1]})
+DETACH DELETE c
+"""
+    return kg.query(query, params={"communities": [list(key) for key in communities]})
+
+
+def mark_communities_outdated(kg: Neo4jGraph | Neo4jPool, communities: list[tuple[int, int]]):
+    """
+    Flag community nodes of `communities` (`(level, community_id)` pairs) which have to be summarized again.
+    They keep their previous report until `create_communities_bulk` replaces it
+    """
+    query = """
+UNWIND $communities AS key
+MATCH (c:Community {level: key[0], id: key[1]})
+SET c.outdated = true
+"""
+    return kg.query(query, params={"communities": [list(key) for key in communities]})
+
+
+def create_community(kg: Neo4jGraph | Neo4jPool, community_id: int, title: str, summary: str, rating: float, rating_explanation: str, findings: str,
+                     embedding=None, level: int = 0):
+    """
+    Create community node of `level`. The summary embedding is only set if `embedding` is given
+    """
+    query = """
+MATCH (e:Entity)
+WITH e, coalesce(e.communityIds, [e.communityId]) AS ids
+WHERE ids[$level] = $community_id
+MERGE (c:Community {id: $community_id, level: $level})
+SET c.title = $title
+SET c.summary = $summary
+SET c.rating = $rating
+SET c.rating_explanation = $rating_explanation
+SET c.findings = $findings
+MERGE (e)-[:BELONG_TO]->(c)
+WITH DISTINCT c
+WHERE $embedding IS NOT NULL
+CALL db.create.setNodeVectorProperty(c, "embedding", $embedding)
+"""
+
+    return kg.query(query, params={
+        "community_id": community_id,
+        "level": level,
+        "title": title,
+        "summary": summary,
+        "rating": float(rating),
+        "rating_explanation": rating_explanation,
+        "findings": findings,
+        "embedding": embedding
+    })
+
+
+def create_communities_bulk(kg: Neo4jGraph | Neo4jPool, communities: list[dict], batch_size: int = 200):
+    """
+    Create community nodes from list of `{community_id, title, summary, rating, rating_explanation, findings, embedding}`
+    objects, using one `UNWIND` query per batch. An optional `level` key gives the community level (default 0).
+    An existing community is replaced: its `outdated` flag and previous `BELONG_TO` / `CHILD_OF` relationships
+    are removed. Members of all communities of a batch are found with a single scan of entities
+    """
+    query = """
+UNWIND $rows AS row
+MERGE (c:Community {id: row.community_id, level: row.level})
+SET c.title = row.title,
+    c.summary = row.summary,
+    c.rating = row.rating,
+    c.rating_explanation = row.rating_explanation,
+    c.findings = row.findings,
+    c.outdated = null
+WITH c, row
+CALL {
+    WITH c
+    MATCH (c)-[old:BELONG_TO|CHILD_OF]-()
+    DELETE old
+}
+CALL {
+    WITH c, row
+    WITH c, row
+    WHERE row.embedding IS NOT NULL
+    CALL db.create.setNodeVectorProperty(c, "embedding", row.embedding)
+}
+WITH collect([row.level, row.community_id]) AS written
 MATCH (e:Entity)
-WHERE e.communityId = {community_id}
-MERGE (c:Community {{id: {community_id}}})
-SET c.title = '{title}'
-SET c.summary = '{summary}'
-SET c.rating = {rating}
-SET c.rating_explanation = '{rating_explanation}'
-SET c.findings = '{findings}'
+WITH written, e, coalesce(e.communityIds, [e.communityId]) AS ids
+UNWIND range(0, size(ids) - 1) AS level
+WITH e, level, ids[level] AS community_id, written
+WHERE [level, community_id] IN written
+MATCH (c:Community {id: community_id, level: level})
 MERGE (e)-[:BELONG_TO]->(c)
-WITH c
-CALL db.create.setNodeVectorProperty(c, "embedding", {embedding})
 """
+    rows = [{
+        "community_id": community["community_id"],
+        "level": community.get("level", 0),
+        "title": community["title"],
+        "summary": community["summary"],
+        "rating": float(community["rating"]),
+        "rating_explanation": community["rating_explanation"],
+        "findings": community["findings"],
+        "embedding": community["embedding"]
+    } for community in communities]
 
+    _write_batches(kg, query, rows, batch_size)
+
+
+def link_community_hierarchy(kg: Neo4jGraph | Neo4jPool):
+    """
+    Create `CHILD_OF` relationship from each community to its parent community of the level above
+    """
+    query = """
+MATCH (e:Entity)
+WITH coalesce(e.communityIds, [e.communityId]) AS ids
+WHERE size(ids) > 1
+UNWIND range(1, size(ids) - 1) AS level
+WITH DISTINCT level, ids[level] AS child_id, ids[level - 1] AS parent_id
+MATCH (child:Community {id: child_id, level: level})
+MATCH (parent:Community {id: parent_id, level: level - 1})
+MERGE (child)-[:CHILD_OF]->(parent)
+"""
     return kg.query(query)
 
 
-def embed_community_summary(kg: Neo4jGraph, index_name: str, vector_dim: int):
+def embed_community_summary(kg: Neo4jGraph | Neo4jPool, index_name: str, vector_dim: int):
     """
     Embed community summary
     """
@@ -155,14 +413,28 @@ OPTIONS {{
 #######
 # GET
 
-def get_list_community(kg: Neo4jGraph):
+def get_community_levels(kg: Neo4jGraph | Neo4jPool) -> int:
+    """
+    Return number of community levels
+    """
+    query = """
+MATCH (e:Entity)
+RETURN max(size(coalesce(e.communityIds, [e.communityId]))) AS levels
+"""
+    return _read(kg, query)[0]["levels"] or 0
+
+
+def get_list_community(kg: Neo4jGraph | Neo4jPool, level: int = 0):
     """
-    Return list of community id
+    Return list of community id of `level`
     """
     query = """
-MATCH (n:Entity) RETURN DISTINCT n.communityId AS communityId
+MATCH (n:Entity)
+WITH coalesce(n.communityIds, [n.communityId])[$level] AS communityId
+WHERE communityId IS NOT NULL
+RETURN DISTINCT communityId
 """
-    result = kg.query(query)
+    result = _read(kg, query, {"level": level})
     output = []
     for obj in result:
         output.append(obj['communityId'])
@@ -170,50 +442,182 @@ MATCH (n:Entity) RETURN DISTINCT n.communityId AS communityId
     return output
 
 
-def get_community_info(kg: Neo4jGraph, community_id: int):
+def get_outdated_communities(kg: Neo4jGraph | Neo4jPool) -> set[tuple[int, int]]:
     """
-    Get all entites and relationship from community `community_id` to fit for community summarize prompt.
+    Return `(level, community_id)` of communities which have members but no community node, or whose node
+    is flagged outdated, i.e. communities whose summarization has not succeeded yet
     """
+    query = """
+MATCH (e:Entity)
+WHERE e.communityId IS NOT NULL
+WITH coalesce(e.communityIds, [e.communityId]) AS ids
+UNWIND range(0, size(ids) - 1) AS level
+WITH DISTINCT level, ids[level] AS communityId
+OPTIONAL MATCH (c:Community {id: communityId, level: level})
+WITH level, communityId, c
+WHERE c IS NULL OR c.outdated = true
+RETURN level, communityId
+"""
+    return {(row["level"], row["communityId"]) for row in _read(kg, query)}
 
-    # Retrieve all entity and relationship related to community
-    query = f"""
-MATCH (e1: Entity)
-WHERE e1.communityId = {community_id}
-RETURN e1.name, e1.description
+
+def get_community_membership(kg: Neo4jGraph | Neo4jPool) -> dict[tuple[int, int], set[str]]:
+    """
+    Return entity names of each community, keyed by `(level, community_id)`
+    """
+    query = """
+MATCH (e:Entity)
+WHERE e.communityId IS NOT NULL
+WITH e, coalesce(e.communityIds, [e.communityId]) AS ids
+UNWIND range(0, size(ids) - 1) AS level
+RETURN level, ids[level] AS communityId, collect(e.name) AS names
 """
+    return {(row["level"], row["communityId"]): set(row["names"]) for row in _read(kg, query)}
 
-    result = kg.query(query)
-    output1 = set()
-    for res in result:
-        if res["e1.description"] is None:
-            res["e1.description"] = "None"
-        output1.add(','.join([res["e1.name"], res["e1.description"]]))
 
-############
-    query = f"""
-MATCH (e1: Entity)-[r:RELATED]->(e2:Entity)
-WHERE e1.communityId = {community_id}
-RETURN e1.name, e2.name, r.description    
+def stream_community_context(kg: Neo4jGraph | Neo4jPool, level: int = 0, community_ids: list[int] | None = None):
+    """
+    Yield the content of every community of `level` (or only `community_ids`), fetched with a single query.
+    Each record is
+
+    `{"communityId": id, "entities": [[name, description, degree], ...], "relationships": [[source, target, description, rank], ...]}`
+
+    where `degree` is the number of relationships of the entity and `rank` the sum of degrees of both ends.
+    All communities are aggregated by one query. With a `Neo4jPool`, records are fetched from the server
+    as they are consumed, callers decide whether to keep them (`get_communities_info` collects all of them)
+    """
+    query = """
+MATCH (e:Entity)
+WITH e, coalesce(e.communityIds, [e.communityId])[$level] AS communityId
+WHERE communityId IS NOT NULL AND ($community_ids IS NULL OR communityId IN $community_ids)
+WITH e, communityId, size([(e)-[:RELATED]-() | 1]) AS degree
+OPTIONAL MATCH (e)-[r:RELATED]->(t:Entity)
+WITH communityId, e, degree,
+     collect(CASE WHEN r IS NULL THEN null ELSE [e.name, t.name, coalesce(r.description, 'None'), degree + size([(t)-[:RELATED]-() | 1])] END) AS relationships
+RETURN communityId,
+       collect([e.name, coalesce(e.description, 'None'), degree]) AS entities,
+       reduce(output = [], rels IN collect(relationships) | output + rels) AS relationships
 """
-    result = kg.query(query)
-    output2 = set()
-    for res in result:
-        if res["r.description"] is None:
-            res["r.description"] = "None"
-        output2.add(','.join((res["e1.name"], res["e2.name"], res["r.description"])))
-    
+    yield from _stream(kg, query, {"level": level, "community_ids": community_ids})
 
-    return list(output1), list(output2)
 
+def get_communities_info(kg: Neo4jGraph | Neo4jPool, level: int = 0, community_ids: list[int] | None = None) -> dict[int, tuple[list[str], list[str]]]:
+    """
+    Get entities and relationships of all communities of `level` (or only `community_ids`) in one query, formatted
+    for community summarize prompt. Return `{community_id: (entity_info, relationship_info)}`
+    """
+    output = {}
+    for record in stream_community_context(kg, level, community_ids):
+        entity_info = {','.join((name, description)) for name, description, _ in record["entities"]}
+        relationship_info = {','.join((source, target, description)) for source, target, description, _ in record["relationships"]}
 
-def get_search_result(kg: Neo4jGraph, index_name: str, result_number: int, query):
-    query = f"""
-CALL db.index.vector.queryNodes("{index_name}", {result_number}, {query})
+        # Sorted, so the same community always gives the same prompt
+        output[record["communityId"]] = (sorted(entity_info), sorted(relationship_info))
+
+    return output
+
+
+def get_community_info(kg: Neo4jGraph | Neo4jPool, community_id: int, level: int = 0):
+    """
+    Get all entites and relationship from community `community_id` of `level` to fit for community summarize prompt.
+    """
+    return get_communities_info(kg, level, [community_id]).get(community_id, ([], []))
+
+
+def get_sub_community_context(kg: Neo4jGraph | Neo4jPool, level: int, community_ids: list[int] | None = None) -> dict[int, dict]:
+    """
+    Get the sub-communities (level `level + 1`) of all communities of `level` (or only `community_ids`), and the
+    relationships between entities of different sub-communities. Return
+
+    `{community_id: {"sub_communities": [[title, summary, rating], ...], "relationships": [[source, target, description, rank], ...]}}`
+    """
+    params = {"level": level, "community_ids": community_ids}
+
+    query = """
+MATCH (e:Entity)
+WITH coalesce(e.communityIds, [e.communityId]) AS ids
+WHERE ids[$level + 1] IS NOT NULL AND ($community_ids IS NULL OR ids[$level] IN $community_ids)
+WITH DISTINCT ids[$level] AS communityId, ids[$level + 1] AS child_id
+MATCH (c:Community {id: child_id, level: $level + 1})
+RETURN communityId, collect([c.title, c.summary, c.rating]) AS sub_communities
+"""
+    output = {
+        row["communityId"]: {"sub_communities": row["sub_communities"], "relationships": []}
+        for row in _read(kg, query, params)
+    }
+
+    query = """
+MATCH (e1:Entity)-[r:RELATED]->(e2:Entity)
+WITH e1, r, e2, coalesce(e1.communityIds, [e1.communityId]) AS ids1, coalesce(e2.communityIds, [e2.communityId]) AS ids2
+WHERE ids1[$level + 1] IS NOT NULL AND ($community_ids IS NULL OR ids1[$level] IN $community_ids)
+AND ids2[$level] = ids1[$level] AND ids2[$level + 1] <> ids1[$level + 1]
+RETURN ids1[$level] AS communityId,
+       collect([e1.name, e2.name, coalesce(r.description, 'None'), size([(e1)-[:RELATED]-() | 1]) + size([(e2)-[:RELATED]-() | 1])]) AS relationships
+"""
+    for row in _read(kg, query, params):
+        output.setdefault(row["communityId"], {"sub_communities": [], "relationships": []})["relationships"] = row["relationships"]
+
+    return output
+
+
+def get_sub_communities_info(kg: Neo4jGraph | Neo4jPool, level: int, community_ids: list[int] | None = None) -> dict[int, tuple[list[str], list[str]]]:
+    """
+    Get summaries of the sub-communities of all communities of `level` (or only `community_ids`) and the relationships
+    between them, formatted for community summarize prompt. Return `{community_id: (sub_community_info, relationship_info)}`
+    """
+    output = {}
+    for id, context in get_sub_community_context(kg, level, community_ids).items():
+        sub_community_info = {','.join((title, summary)) for title, summary, _ in context["sub_communities"]}
+        relationship_info = {','.join((source, target, description)) for source, target, description, _ in context["relationships"]}
+        output[id] = (sorted(sub_community_info), sorted(relationship_info))
+
+    return output
+
+
+def get_sub_community_info(kg: Neo4jGraph | Neo4jPool, community_id: int, level: int):
+    """
+    Get summaries of the sub-communities (level `level + 1`) of community `community_id`, and the relationships
+    between entities of different sub-communities, to summarize a community from its sub-communities
+    """
+    return get_sub_communities_info(kg, level, [community_id]).get(community_id, ([], []))
+
+
+def get_communities(kg: Neo4jGraph | Neo4jPool):
+    """
+    Return all community nodes with their summary embedding
+    """
+    query = """
+MATCH (c:Community)
+WHERE c.embedding IS NOT NULL
+RETURN c.id AS id, coalesce(c.level, 0) AS level, c.title AS title, c.summary AS summary, c.rating AS rating, c.rating_explanation AS re, c.findings AS findings, c.embedding AS embedding
+"""
+    return _read(kg, query)
+
+
+def get_search_result(kg: Neo4jGraph | Neo4jPool, index_name: str, result_number: int, query, level: int | None = None):
+    """
+    Return `result_number` communities closest to embedding vector `query`.
+
+    If `level` is given, only communities of that level are searched. The vector index can not be filtered,
+    so they are scored exactly, which is cheap since upper levels only have a few communities
+    """
+    if level is None:
+        cypher = """
+CALL db.index.vector.queryNodes($index_name, $result_number, $embedding)
 YIELD node AS c, score
 RETURN c.title AS title, c.summary AS summary, c.rating AS rating, c.rating_explanation AS re, c.findings as findings, score
+"""
+    else:
+        cypher = """
+MATCH (c:Community)
+WHERE coalesce(c.level, 0) = $level AND c.embedding IS NOT NULL
+WITH c, vector.similarity.cosine(c.embedding, $embedding) AS score
+ORDER BY score DESC
+LIMIT $result_number
+RETURN c.title AS title, c.summary AS summary, c.rating AS rating, c.rating_explanation AS re, c.findings as findings, score
 """
     
-    result = kg.query(query)
+    result = _read(kg, cypher, {"index_name": index_name, "result_number": result_number, "embedding": list(query), "level": level})
     output = []
     for res in result:
         output.append([res["title"], res["summary"], res["rating"], res["re"], res["findings"], res["score"]])
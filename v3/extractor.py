@@ -1,8 +1,11 @@
 from prompts import graph_extractor_prompts, summarize_prompts
 from LLM import LLM
+from checkpoint import CheckpointStore, hash_text
 import json
 import cypher_query as cq
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 
 DEFAULT_TUPLE_DELIMITER = "<TD>"
 DEFAULT_RECORD_DELIMITER = "<RD>"
@@ -20,12 +23,31 @@ class GraphExtractor:
 
     """
     # Private
-    def __init__(self, llm: LLM) -> None:
+    def __init__(self, llm: LLM, checkpoint: CheckpointStore | None = None) -> None:
+        """
+        Parameters
+        -
+        checkpoint: If given, completed chunk extractions and key summarizations are recorded in the store
+        and skipped when they are run again
+        """
         self.__llm = llm
+        self.__checkpoint = checkpoint
         self.temp: dict[str, list[str]] = {}
+        # Document ids where each key of `temp` was found
+        self.sources: dict[str, set[str]] = {}
         # Data is stored in JSON format
         self.data = []
+        # Keys of `temp` which received new descriptions since last `summarize`
+        self.dirty: set[str] = set()
+        # Data objects created or updated by last `summarize`
+        self.changed: list[dict] = []
+        # Position of each key of `temp` in `data`
+        self.__data_index: dict[str, int] = {}
         self.error_count = 0
+        # Index of chunks which failed in the last `extract_many` call
+        self.failed_chunks: list[int] = []
+        # Guard `temp` and `error_count` when chunks are extracted concurrently
+        self.__lock = threading.Lock()
         
 
     def __create_graph_prompt(self, input_text: str) -> str:
@@ -42,21 +64,61 @@ class GraphExtractor:
             entity_name, description_list
         )
     
-    def __entity_json_format(self, entity_name, entity_type, description):
+    def __entity_json_format(self, entity_name, entity_type, description, doc_ids):
         return {
             "entity_name": entity_name,
             "entity_type": entity_type,
-            "description": description
+            "description": description,
+            "doc_ids": doc_ids
         }
     
-    def __relationship_json_format(self, source_entity, target_entity, description):
+    def __relationship_json_format(self, source_entity, target_entity, description, doc_ids):
         return {
             "source_entity": source_entity,
             "target_entity": target_entity,
-            "description": description
+            "description": description,
+            "doc_ids": doc_ids
         }
     
-    def __preprocess(self, result: str):
+    def __extract(self, text: str, attempt_limit: int):
+        """
+        Call LLM until it completes the extraction of `text`. Return None if `attempt_limit` is exceeded
+        """
+        # Chunk has already been extracted in previous run
+        chunk_key = hash_text(text)
+        if self.__checkpoint is not None and self.__checkpoint.has("extract", chunk_key):
+            return self.__checkpoint.get("extract", chunk_key)
+
+        # Get llm extraction response 
+        prompt = self.__create_graph_prompt(text)
+        result = ""
+
+        # Check if the model has finished the extraction
+        attempt = 0
+        while result.find(DEFAULT_COMPLETION_DELIMITER) == -1:
+            if attempt > attempt_limit:
+                return None
+            
+            attempt += 1
+            
+            try:
+                result = self.__llm.generate(prompt)
+            except Exception as error:
+                print(f"Error: {error} \n\n-Attempt: {attempt} \n")
+                continue
+
+            # Incomplete response must not be served again from cache
+            if result.find(DEFAULT_COMPLETION_DELIMITER) == -1:
+                self.__llm.invalidate(prompt)
+
+        result = result.replace(DEFAULT_COMPLETION_DELIMITER, '')
+
+        if self.__checkpoint is not None:
+            self.__checkpoint.put("extract", chunk_key, result)
+
+        return result
+
+    def __preprocess(self, result: str, doc_id: str | None = None):
         """
         Preprocess result and store in class total temp. 
 
@@ -87,15 +149,39 @@ class GraphExtractor:
                 self.temp[key] = []
 
             self.temp[key].append(parts[3])
+            self.dirty.add(key)
+
+            if doc_id is not None:
+                self.sources.setdefault(key, set()).add(doc_id)
 
 
     #############################
     # Public
-    def summarize(self, cooldown=1):
+    def summarize(self, cooldown=0, incremental=False):
         """
         Merge all duplicated entities and relationships 
+
+        Parameters
+        -
+        cooldown: seconds to sleep after each LLM call. Prefer giving the LLM a `RateLimiter`,
+        which follows the provider quota and retries rate limit errors
+
+        incremental: If true, only keys which received new descriptions since last call are summarized,
+        and their objects in `data` are replaced. Otherwise `data` is rebuilt from all keys.
+
+        Objects created or updated are listed in `changed`. A key whose summarization failed keeps its first
+        description and stays in `dirty`, so the next incremental call retries it
         """
-        for item in self.temp.items():
+        if incremental:
+            items = [(key, self.temp[key]) for key in self.temp.keys() if key in self.dirty]
+        else:
+            items = list(self.temp.items())
+            self.data = []
+            self.__data_index = {}
+
+        self.changed = []
+
+        for item in items:
             # Call llm to summarize
 
             parts = item[0].split(DEFAULT_TUPLE_DELIMITER)
@@ -110,21 +196,94 @@ class GraphExtractor:
 
             # If the obj only has 1 description then skip summarization
             summarized = item[1][0]
+            failed = False
 
-            if len(item[1]) > 1:
+            # Merge key with the same descriptions has already been summarized in previous run
+            summarize_key = hash_text(item[0], *item[1])
+
+            if len(item[1]) > 1 and self.__checkpoint is not None and self.__checkpoint.has("summarize", summarize_key):
+                summarized = self.__checkpoint.get("summarize", summarize_key)
+
+            elif len(item[1]) > 1:
                 prompt = self.__create_summarize_prompt(entity_name, item[1])
                 # In-case of safety setting
                 try:
                     summarized = self.__llm.generate(prompt)
+
+                    if self.__checkpoint is not None:
+                        self.__checkpoint.put("summarize", summarize_key, summarized)
                 except Exception as error:
+                    failed = True
                     print(f"Error: {error} \n\n-Key: {entity_name} \n-Description: {item[1]} \n")
 
-                time.sleep(cooldown)
+                if cooldown > 0:
+                    time.sleep(cooldown)
+
+            doc_ids = sorted(self.sources.get(item[0], []))
 
             if isinstance(entity_name, str):
-                self.data.append(self.__entity_json_format(key1, key2, summarized))
+                obj = self.__entity_json_format(key1, key2, summarized, doc_ids)
             else:
-                self.data.append(self.__relationship_json_format(key1, key2, summarized))
+                obj = self.__relationship_json_format(key1, key2, summarized, doc_ids)
+
+            if item[0] in self.__data_index:
+                self.data[self.__data_index[item[0]]] = obj
+            else:
+                self.__data_index[item[0]] = len(self.data)
+                self.data.append(obj)
+
+            self.changed.append(obj)
+            if not failed:
+                self.dirty.discard(item[0])
+
+
+    def changed_entities(self) -> set[str]:
+        """
+        Return names of entities created or updated by last `summarize`, including both ends of updated relationships
+        """
+        names = set()
+        for obj in self.changed:
+            if "entity_name" in obj:
+                names.add(obj["entity_name"])
+            else:
+                names.update((obj["source_entity"], obj["target_entity"]))
+
+        return names
+
+
+    def save_state(self, json_path: str):
+        """
+        Save extraction state (`temp`, document ids, keys not summarized yet and summarized data) in JSON format,
+        so `summarize(incremental=True)` can continue in another session after `load_state`
+        """
+        state = {
+            "temp": self.temp,
+            "sources": {key: sorted(doc_ids) for key, doc_ids in self.sources.items()},
+            "dirty": sorted(self.dirty),
+            "data": self.data,
+            "data_index": self.__data_index
+        }
+
+        with open(json_path, 'w') as fp:
+            json.dump(state, fp)
+
+    def load_state(self, json_path: str):
+        """
+        Load state saved by `save_state`. A file which only contains `temp` (older format) is loaded
+        with every key not summarized yet
+        """
+        with open(json_path, 'r') as fp:
+            state = json.load(fp)
+
+        if not isinstance(state.get("temp"), dict):
+            state = {"temp": state, "dirty": list(state.keys())}
+
+        self.temp = state["temp"]
+        self.sources = {key: set(doc_ids) for key, doc_ids in state.get("sources", {}).items()}
+        self.dirty = set(state.get("dirty", []))
+        self.data = state.get("data", [])
+        self.__data_index = state.get("data_index", {})
+        self.changed = []
 
 
     def save_data(self, json_path: str):
@@ -138,7 +297,7 @@ class GraphExtractor:
 
 
     
-    def extract_text(self, text: str, attempt_limit=5, store=True):
+    def extract_text(self, text: str, attempt_limit=5, store=True, doc_id: str | None = None):
         """
         Extract *entities* and *relationship* from a text string
 
@@ -147,102 +306,361 @@ class GraphExtractor:
         attempt_limit: maximum number of LLM extraction attempts.
 
         store: If true, the extracted *entities* and *relationship* will be stored in class. Merge any duplication
-        """
-        # Get llm extraction response 
-        prompt = self.__create_graph_prompt(text)
-        result = ""
 
-        # Check if the model has finished the extraction
-        attempt = 0
-        while result.find(DEFAULT_COMPLETION_DELIMITER) == -1:
-            if attempt > attempt_limit:
-                print(f"Model failed to extract information from: \n{text}\n")
-                return ""
-            
-            attempt += 1
-            
-            try:
-                result = self.__llm.generate(prompt)
-            except:
-                continue
-            
+        doc_id: id of the document `text` belongs to, recorded in `sources`
+        """
+        result = self.__extract(text, attempt_limit)
 
-        result = result.replace(DEFAULT_COMPLETION_DELIMITER, '')
+        if result is None:
+            print(f"Model failed to extract information from: \n{text}\n")
+            return ""
 
         if store:
-            self.__preprocess(result)
+            with self.__lock:
+                self.__preprocess(result, doc_id)
 
         return result
+
+
+    def extract_many(self, chunks, workers=4, attempt_limit=5, store=True):
+        """
+        Extract *entities* and *relationship* from text chunks concurrently.
+        Each chunk is retried until the model completes the extraction, as `extract_text`
+
+        Parameters
+        -
+        chunks: list or iterable of text, or of `{"text", "doc_id"}` objects. An iterable is consumed
+        while chunks are extracted, at most `2 * workers` chunks are waiting at the same time.
+
+        workers: maximum number of chunks extracted at the same time.
+
+        Return list of extraction results in the same order as `chunks`. Index of failed chunks
+        are stored in `failed_chunks`
+        """
+        results = []
+        self.failed_chunks = []
+        total = len(chunks) if hasattr(chunks, "__len__") else None
+        count = 0
+
+        def collect(future, i, doc_id):
+            nonlocal count
+            count += 1
+            result = future.result()
+
+            if result is None:
+                print(f"Chunk {i}: model failed to extract information \n")
+                self.failed_chunks.append(i)
+            else:
+                results[i] = result
+                if store:
+                    with self.__lock:
+                        self.__preprocess(result, doc_id)
+
+            if count % 10 == 0 or count == total:
+                print(f"Chunk count: {count}/{total if total is not None else '?'} (failed: {len(self.failed_chunks)})")
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = {}
+
+            for i, chunk in enumerate(chunks):
+                text, doc_id = (chunk, None) if isinstance(chunk, str) else (chunk["text"], chunk.get("doc_id"))
+
+                results.append("")
+                pending[executor.submit(self.__extract, text, attempt_limit)] = (i, doc_id)
+
+                # Backpressure: wait for a chunk to finish before reading more chunks
+                if len(pending) >= 2 * workers:
+                    finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        collect(future, *pending.pop(future))
+
+            for future in as_completed(pending):
+                collect(future, *pending[future])
+
+        self.failed_chunks.sort()
+        return results
     
 
 
-from langchain_community.graphs import Neo4jGraph 
-from dotenv import load_dotenv
+from neo4j_pool import Neo4jPool, get_pool
+from EmbeddingModel import EmbeddingModel
+from context_packer import ContextPacker
 from prompts import community_summarize_prompts
-import os
 
 
 
 class CommunityExtractor:
-    def __init__(self, llm: LLM):
-        load_dotenv()
+    def __init__(self, llm: LLM, checkpoint: CheckpointStore | None = None, pool: Neo4jPool | None = None,
+                 em: EmbeddingModel | None = None, packer: ContextPacker | None = None):
+        """
+        Parameters
+        -
+        checkpoint: If given, completed community summaries are recorded in the store and skipped when
+        they are run again
+
+        pool: Neo4j connection pool. If None, the process-wide shared pool is used
 
-        NEO4J_URL = os.getenv('NEO4J_URL')
-        NEO4J_USERNAME = os.getenv('NEO4J_USERNAME')
-        NEO4J_PASSWORD = os.getenv('NEO4J_PASSWORD')
-        NEO4J_DATABASE = os.getenv('NEO4J_DATABASE')
+        em: If given, community summaries are embedded, so communities can be searched by vector
 
+        packer: If given, community content is packed into its token budget, most connected entities and
+        relationships first. A community of an upper level is summarized from its own content when it fits
+        in the budget, otherwise from its sub-communities. If None, the whole content is sent
+        """
         self.__llm = llm
+        self.__em = em
+        self.__packer = packer
+        self.__checkpoint = checkpoint
         try:
-            self.__kg = Neo4jGraph(NEO4J_URL, NEO4J_USERNAME, NEO4J_PASSWORD, NEO4J_DATABASE)
+            self.__kg = pool if pool is not None else get_pool()
+            self.__kg.verify()
             
         except Exception as excpt:
-            raise NameError(f"Failed to initialize Neo4jGraph. \nError: {excpt}\n")
+            raise NameError(f"Failed to connect to Neo4j. \nError: {excpt}\n")
 
-    def __create_community_summarize_prompt(self, entity_info: list[str], relationship_info: list[str]):
+    def __create_community_summarize_prompt(self, entity_info: list[str], relationship_info: list[str],
+                                            sub_community_info: list[str] | None = None):
         return community_summarize_prompts.get_prompt(
-            entity_info, relationship_info
+            entity_info, relationship_info, sub_community_info
         )
 
-    def __preprocess(self, community_id: int, result: str):
-        data = json.loads(result)
-        
-        # Only load title & summary
-        title, summary, rating, rating_explanation = data["title"], data["summary"], data['rating'], data['rating_explanation']
+    def __preprocess(self, community_id: int, result: str, level: int = 0) -> dict:
+        """
+        Convert community report into a row of `cypher_query.create_communities_bulk`
+        """
+        # Drop markdown code fence around the JSON object
+        data = json.loads(result[result.find('{'):result.rfind('}') + 1])
+
+        return {
+            "community_id": community_id,
+            "level": level,
+            "title": data["title"],
+            "summary": data["summary"],
+            "rating": float(data["rating"]),
+            "rating_explanation": data["rating_explanation"],
+            # convert findings into string
+            "findings": json.dumps(data["findings"]),
+            "embedding": None
+        }
 
-        cq.create_community(self.__kg, community_id, title, summary, float(rating), rating_explanation)
+    def __write(self, rows: list[dict]):
+        """
+        Embed summaries of `rows` in one batch and create their community nodes
+        """
+        if len(rows) == 0:
+            return
+
+        if self.__em is not None:
+            embeddings = self.__em.embed_batch([row["summary"] for row in rows])
+            for row, embedding in zip(rows, embeddings):
+                row["embedding"] = [float(value) for value in embedding]
 
+        cq.create_communities_bulk(self.__kg, rows)
 
 
-    def extract(self, graph_name: str, attempt_limit: int = 5):
+
+    def __update_communities(self, graph_name: str, changed_entities: set[str], hierarchical: bool) -> set[tuple[int, int]]:
         """
-        Detect and summarize communities from `graph_name`. Each community will be stored in community node
+        Re-run Leiden seeded with current communities and return `(level, community_id)` of communities which have
+        to be summarized again: communities whose members changed, which contain a changed entity,
+        whose summarization failed in a previous run or which have an updated sub-community
         """
-        cq.generate_communities(self.__kg, graph_name)
+        before = cq.get_community_membership(self.__kg)
 
-        # Retrieve list of community id
-        cid = cq.get_list_community(self.__kg)
+        # New entities start in their own community, existing ones keep their bottom level community as seed
+        cq.seed_new_entities(self.__kg)
+        cq.drop_projected_graph(self.__kg, graph_name)
+        cq.create_entity_projection(self.__kg, graph_name, ["seedCommunityId"])
+        cq.generate_communities(self.__kg, graph_name, seed_property="seedCommunityId", include_intermediate=hierarchical)
 
+        after = cq.get_community_membership(self.__kg)
+
+        update = {
+            key for key in after
+            if after[key] != before.get(key) or not after[key].isdisjoint(changed_entities)
+        }
+        update |= cq.get_outdated_communities(self.__kg)
+
+        # A community is summarized from its sub-communities, so it is updated with them
+        levels = max((level for level, _ in after), default=-1) + 1
+        for level in reversed(range(levels - 1)):
+            members = set().union(*(after[key] for key in update if key[0] == level + 1))
+            update |= {key for key in after if key[0] == level and not after[key].isdisjoint(members)}
+
+        # Removed communities are dropped. Changed communities keep their report until a new one is written,
+        # the outdated flag is kept if it fails so the next run retries them
+        cq.delete_communities(self.__kg, sorted(key for key in before if key not in after))
+        cq.mark_communities_outdated(self.__kg, sorted(update))
+
+        return update
+
+
+    def __create_level_prompts(self, level: int, levels: int, cid: list[int]) -> dict[int, str]:
+        """
+        Build summarize prompt of every community of `level` in `cid`, their content is fetched with aggregated queries
+        """
+        if self.__packer is not None:
+            return self.__create_packed_level_prompts(level, levels, cid)
+
+        if level == levels - 1:
+            info = cq.get_communities_info(self.__kg, level, cid)
+            return {
+                id: self.__create_community_summarize_prompt(*info.get(id, ([], [])))
+                for id in cid
+            }
+
+        # Upper level community is summarized from summaries of its sub-communities
+        info = cq.get_sub_communities_info(self.__kg, level, cid)
+        prompts = {}
         for id in cid:
-            entities, relationships = cq.get_community_info(self.__kg, id)
+            sub_communities, relationships = info.get(id, ([], []))
+            prompts[id] = self.__create_community_summarize_prompt([], relationships, sub_communities)
 
-            # Community Summarize
-            prompt = self.__create_community_summarize_prompt(entities, relationships)
-            result = ""
-            attempt = 0
+        return prompts
 
-            while result.find('"title"') == -1 and attempt <= attempt_limit:                    
-                attempt += 1
-                try:
-                    result = self.__llm.generate(prompt)
-                except Exception as exp:
-                    print(f"Error: {exp}\n-Community ID: {id}")
+    def __create_packed_level_prompts(self, level: int, levels: int, cid: list[int]) -> dict[int, str]:
+        prompts = {}
+        oversized = []
 
-            if attempt > attempt_limit:
-                print(f"Failed to extract summary from community {id}")
+        for record in cq.stream_community_context(self.__kg, level, cid):
+            entity_info, relationship_info, complete = self.__packer.pack_community(record["entities"], record["relationships"])
+
+            # Bottom level has no sub-community, its most connected content is kept
+            if complete or level == levels - 1:
+                prompts[record["communityId"]] = self.__create_community_summarize_prompt(entity_info, relationship_info)
+            else:
+                oversized.append(record["communityId"])
+
+        # Oversized communities fall back to reports of their sub-communities
+        if len(oversized) > 0:
+            context = cq.get_sub_community_context(self.__kg, level, oversized)
+            for id in oversized:
+                sub_communities, relationships = self.__packer.pack_sub_communities(
+                    context.get(id, {}).get("sub_communities", []), context.get(id, {}).get("relationships", [])
+                )
+                prompts[id] = self.__create_community_summarize_prompt([], relationships, sub_communities)
+
+        return prompts
+
+    def __summarize(self, id: int, level: int, prompt: str, attempt_limit: int) -> tuple[str, dict] | None:
+        """
+        Ask the model to summarize a community until it returns a valid report.
+        Return the report and its row, None on failure
+        """
+        attempt = 0
+
+        while attempt <= attempt_limit:
+            attempt += 1
+            try:
+                result = self.__llm.generate(prompt)
+            except Exception as exp:
+                print(f"Error: {exp}\n-Community ID: {id}")
                 continue
 
-            self.__preprocess(id, result)
+            try:
+                return result, self.__preprocess(id, result, level)
+            except (ValueError, KeyError):
+                # Incomplete or invalid report, it must not be returned again by a cache
+                self.__llm.invalidate(prompt)
+
+        print(f"Failed to extract summary from community {id} (level {level})")
+        return None
+
+    def __summarize_level(self, prompts: dict[int, str], level: int, attempt_limit: int, workers: int, batch_size: int):
+        """
+        Summarize communities of one level concurrently. Finished communities are written in batches of
+        `batch_size` while the others are still summarized
+        """
+        rows = []
+        failed = 0
+
+        def add(row: dict):
+            rows.append(row)
+            if len(rows) >= batch_size:
+                self.__write(rows)
+                rows.clear()
+
+        todo = {}
+        for id, prompt in prompts.items():
+            # Community with the same content has already been summarized in previous run
+            community_key = hash_text(str(id), prompt)
+            if self.__checkpoint is not None and self.__checkpoint.has("community", community_key):
+                try:
+                    add(self.__preprocess(id, self.__checkpoint.get("community", community_key), level))
+                    continue
+                except (ValueError, KeyError):
+                    # Invalid report recorded by an older run, summarized again
+                    pass
+
+            todo[id] = (prompt, community_key)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = {
+                executor.submit(self.__summarize, id, level, prompt, attempt_limit): (id, community_key)
+                for id, (prompt, community_key) in todo.items()
+            }
+
+            for future in as_completed(futures):
+                id, community_key = futures[future]
+                summary = future.result()
+                if summary is None:
+                    failed += 1
+                    continue
+
+                # Only valid reports are recorded
+                result, row = summary
+                if self.__checkpoint is not None:
+                    self.__checkpoint.put("community", community_key, result)
+
+                add(row)
+
+        self.__write(rows)
+        print(f"Level {level}: {len(prompts) - failed}/{len(prompts)} communities summarized")
+
+
+    def extract(self, graph_name: str, attempt_limit: int = 5, incremental: bool = False,
+                changed_entities: set[str] | None = None, hierarchical: bool = False,
+                workers: int = 8, batch_size: int = 200):
+        """
+        Detect and summarize communities from `graph_name`. Each community will be stored in community node
+
+        Parameters
+        -
+        incremental: If True, communities of the previous run are used as seeds of Leiden and only communities
+        affected by new or changed entities are summarized again. `graph_name` is re-projected from current entities
+
+        changed_entities: names of new or updated entities (see `GraphExtractor.changed_entities`), used in incremental mode
+
+        hierarchical: If True, every Leiden level is stored. Communities of the bottom level are summarized from
+        their entities, communities of upper levels from their sub-communities, and each community is linked
+        to its parent by `CHILD_OF` relationship. Level 0 has the largest communities
+
+        workers: maximum number of communities summarized at the same time. Communities of a level are independent,
+        levels are summarized one after another
+
+        batch_size: number of finished communities embedded and written together
+        """
+        update = None
+        if incremental:
+            update = self.__update_communities(graph_name, changed_entities or set(), hierarchical)
+            print(f"Communities to summarize: {len(update)}")
+        else:
+            cq.generate_communities(self.__kg, graph_name, include_intermediate=hierarchical)
+
+        levels = cq.get_community_levels(self.__kg)
+
+        # Bottom level first, so sub-community summaries exist when their parent is summarized
+        for level in reversed(range(levels)):
+            if update is None:
+                # Retrieve list of community id
+                cid = cq.get_list_community(self.__kg, level)
+            else:
+                cid = sorted(id for key_level, id in update if key_level == level)
+
+            prompts = self.__create_level_prompts(level, levels, cid)
+            self.__summarize_level(prompts, level, attempt_limit, workers, batch_size)
+
+        if levels > 1:
+            cq.link_community_hierarchy(self.__kg)
 
             
 
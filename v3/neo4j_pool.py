@@ -0,0 +1,97 @@
+"""Shared Neo4j driver and session management"""
+
+import os
+import threading
+from dotenv import load_dotenv
+from neo4j import GraphDatabase, RoutingControl, READ_ACCESS, WRITE_ACCESS
+
+class Neo4jPool:
+    """
+    Neo4j driver with a connection pool, shared by every component of the pipeline.
+    Connection settings default to `NEO4J_URL`, `NEO4J_USERNAME`, `NEO4J_PASSWORD` and `NEO4J_DATABASE` env variables.
+
+    `query` has the same signature as `Neo4jGraph.query`, so the pool can be passed to every `cypher_query` function.
+    `read` and `write` route the query to a reader or the writer of a cluster, `stream` iterates records
+    without loading the whole result.
+
+    Parameters
+    -
+    max_pool_size: maximum number of connections kept by the driver
+
+    acquisition_timeout: maximum time (seconds) to wait for a free connection
+    """
+    def __init__(self, url: str | None = None, username: str | None = None, password: str | None = None,
+                 database: str | None = None, max_pool_size: int = 50, acquisition_timeout: float = 60.0):
+        load_dotenv()
+
+        url = url or os.getenv('NEO4J_URL')
+        username = username or os.getenv('NEO4J_USERNAME')
+        password = password or os.getenv('NEO4J_PASSWORD')
+        self.database = database or os.getenv('NEO4J_DATABASE')
+
+        self.driver = GraphDatabase.driver(
+            url,
+            auth=(username, password),
+            max_connection_pool_size=max_pool_size,
+            connection_acquisition_timeout=acquisition_timeout
+        )
+
+    def verify(self):
+        """
+        Raise an error if the database can not be reached
+        """
+        self.driver.verify_connectivity()
+
+    def session(self, write: bool = False):
+        """
+        Return a session borrowed from the pool, use it as a context manager.
+        A session can run many queries and transactions
+        """
+        return self.driver.session(
+            database=self.database,
+            default_access_mode=WRITE_ACCESS if write else READ_ACCESS
+        )
+
+    def __execute(self, query: str, params: dict, routing: RoutingControl) -> list[dict]:
+        records, _, _ = self.driver.execute_query(query, params or {}, database_=self.database, routing_=routing)
+        return [record.data() for record in records]
+
+    def query(self, query: str, params: dict | None = None) -> list[dict]:
+        """
+        Run `query` on the writer and return list of records, as `Neo4jGraph.query`
+        """
+        return self.__execute(query, params, RoutingControl.WRITE)
+
+    def read(self, query: str, params: dict | None = None) -> list[dict]:
+        return self.__execute(query, params, RoutingControl.READ)
+
+    def write(self, query: str, params: dict | None = None) -> list[dict]:
+        return self.__execute(query, params, RoutingControl.WRITE)
+
+    def stream(self, query: str, params: dict | None = None, write: bool = False):
+        """
+        Yield records of `query` one by one, records are fetched from the server as they are consumed
+        """
+        with self.session(write) as session:
+            for record in session.run(query, params or {}):
+                yield record.data()
+
+    def close(self):
+        self.driver.close()
+
+
+
+_shared_pool: Neo4jPool | None = None
+_shared_lock = threading.Lock()
+
+def get_pool(**kwargs) -> Neo4jPool:
+    """
+    Return the process-wide pool, it is created on first call with `kwargs`
+    """
+    global _shared_pool
+
+    with _shared_lock:
+        if _shared_pool is None:
+            _shared_pool = Neo4jPool(**kwargs)
+
+        return _shared_pool
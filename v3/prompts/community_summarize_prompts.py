@@ -2,9 +2,13 @@
 
 
 # NOTE: this prompt is modified to fit custom structure
-def get_prompt(entity_info: list[str], relationship_info: list[str]):
+def get_prompt(entity_info: list[str], relationship_info: list[str], sub_community_info: list[str] | None = None):
 
-    entity_info = '\n'.join(entity_info)
+    # Upper level communities are described by reports of their sub-communities instead of their entities
+    if sub_community_info is None:
+        member_info = "Entities\n\nentity,description\n" + '\n'.join(entity_info)
+    else:
+        member_info = "Sub-community reports\n\ntitle,summary\n" + '\n'.join(sub_community_info)
     relationship_info = '\n'.join(relationship_info)
     
     COMMUNITY_REPORT_PROMPT = f"""
@@ -95,10 +99,7 @@ Output:
 
 Use the following text for your answer. Do not make anything up in your answer.
 
-Entities
-
-entity,description
-{entity_info}
+{member_info}
 
 Relationships
 
@@ -0,0 +1,165 @@
+"""Client side rate limiting for LLM requests"""
+
+import time
+import random
+import asyncio
+import threading
+import tiktoken
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. The bucket holds at most `capacity` tokens and is refilled
+    with `capacity` tokens every `period` seconds.
+
+    A reservation is always granted, the balance may become negative. The returned value is
+    the time the caller has to wait before using its reservation, so concurrent callers are served in order.
+    """
+    def __init__(self, capacity: float, period: float = 60.0):
+        assert capacity > 0
+
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.__tokens = capacity
+        self.__last = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        """
+        Take `amount` tokens from the bucket and return the waiting time (seconds)
+        """
+        # A request larger than the bucket would never be served
+        amount = min(amount, self.capacity)
+
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__last) * self.rate)
+            self.__last = now
+
+            self.__tokens -= amount
+            if self.__tokens >= 0:
+                return 0.0
+
+            return -self.__tokens / self.rate
+
+
+
+class RateLimiter:
+    """
+    Shared rate limiter of LLM requests. A single instance can be passed to several models and used by
+    concurrent callers.
+
+    Parameters
+    -
+    requests_per_minute: maximum number of requests per minute. None means unlimited
+
+    tokens_per_minute: maximum number of prompt tokens per minute. None means unlimited
+
+    max_retries: maximum number of retries when the provider returns a rate limit error (429 / resource exhausted)
+
+    base_delay, max_delay: bounds (seconds) of the jittered exponential backoff
+    """
+    def __init__(self, requests_per_minute: int | None = None, tokens_per_minute: int | None = None,
+                 max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0,
+                 encoding_name: str = "cl100k_base"):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tokenizer = tiktoken.get_encoding(encoding_name) if tokens_per_minute else None
+
+        # When the provider rejects a request, every caller pauses until this time
+        self.__blocked_until = 0.0
+        self.__lock = threading.Lock()
+
+    def count_tokens(self, prompt: str) -> int:
+        if self.tokenizer is None:
+            return 0
+
+        return len(self.tokenizer.encode(prompt, disallowed_special=()))
+
+    def __reserve(self, prompt: str) -> float:
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            wait = max(wait, self.token_bucket.reserve(self.count_tokens(prompt)))
+
+        with self.__lock:
+            wait = max(wait, self.__blocked_until - time.monotonic())
+
+        return wait
+
+    def __backoff(self, attempt: int) -> float:
+        """
+        Jittered exponential backoff. The pause is shared with all other callers
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = random.uniform(delay / 2, delay)
+
+        with self.__lock:
+            self.__blocked_until = max(self.__blocked_until, time.monotonic() + delay)
+
+        return delay
+
+    @staticmethod
+    def is_rate_limit_error(error: Exception) -> bool:
+        """
+        Check if `error` is a rate limit error of Gemini (ResourceExhausted) or OpenAI (RateLimitError) clients
+        """
+        if type(error).__name__ in ("ResourceExhausted", "RateLimitError", "TooManyRequests"):
+            return True
+
+        if getattr(error, "status_code", None) == 429 or getattr(error, "code", None) == 429:
+            return True
+
+        # A bare "429" in the message may be an id or a count, only explicit rate limit wording is matched
+        message = str(error).lower()
+        return "resource exhausted" in message or "resource_exhausted" in message or "rate limit" in message
+
+    def acquire(self, prompt: str):
+        """
+        Block until `prompt` can be sent
+        """
+        wait = self.__reserve(prompt)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, prompt: str):
+        wait = self.__reserve(prompt)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def call(self, func, prompt: str):
+        """
+        Call `func(prompt)` under the rate limit, retry with backoff on rate limit errors
+        """
+        attempt = 0
+        while True:
+            self.acquire(prompt)
+            try:
+                return func(prompt)
+            except Exception as error:
+                if attempt >= self.max_retries or not self.is_rate_limit_error(error):
+                    raise
+
+                delay = self.__backoff(attempt)
+                print(f"Rate limited, retry in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                attempt += 1
+
+    async def acall(self, func, prompt: str):
+        """
+        Asynchronous version of `call`, `func` is a coroutine function
+        """
+        attempt = 0
+        while True:
+            await self.aacquire(prompt)
+            try:
+                return await func(prompt)
+            except Exception as error:
+                if attempt >= self.max_retries or not self.is_rate_limit_error(error):
+                    raise
+
+                delay = self.__backoff(attempt)
+                print(f"Rate limited, retry in {delay:.1f}s ({attempt + 1}/{self.max_retries})")
+                attempt += 1
@@ -0,0 +1,60 @@
+"""Drop irrelevant communities before they are sent to the model"""
+
+class RelevanceGate:
+    """
+    Cheap filter of retrieved communities (`[title, summary, rating, rating_explanation, findings, score]`,
+    the rows of `cypher_query.get_search_result`). Each community kept costs one LLM call, so communities
+    which are clearly irrelevant are dropped before answering.
+
+    Parameters
+    -
+    min_score: minimum vector similarity score
+
+    min_relative_score: minimum score as a fraction of the best score, cuts off the tail of results
+    once the scores drop off
+
+    min_rating: minimum community rating (impact severity)
+
+    min_k: the `min_k` best communities are always kept, so a query is never left without context
+
+    max_k: maximum number of communities kept, it is also the number of communities retrieved
+    """
+    def __init__(self, min_score: float | None = None, min_relative_score: float | None = None,
+                 min_rating: float | None = None, min_k: int = 1, max_k: int = 20):
+        assert 0 <= min_k <= max_k
+
+        self.min_score = min_score
+        self.min_relative_score = min_relative_score
+        self.min_rating = min_rating
+        self.min_k = min_k
+        self.max_k = max_k
+
+    def __relevant(self, community, best_score: float) -> bool:
+        rating, score = community[2], community[5]
+
+        if self.min_score is not None and score < self.min_score:
+            return False
+
+        if self.min_relative_score is not None and score < best_score * self.min_relative_score:
+            return False
+
+        if self.min_rating is not None and (rating is None or rating < self.min_rating):
+            return False
+
+        return True
+
+    def filter(self, communities: list) -> list:
+        """
+        Return relevant communities sorted by score, at least `min_k` and at most `max_k` of them
+        """
+        communities = sorted(communities, key=lambda community: community[5], reverse=True)
+        if len(communities) == 0:
+            return []
+
+        best_score = communities[0][5]
+        kept = [
+            community for i, community in enumerate(communities)
+            if i < self.min_k or self.__relevant(community, best_score)
+        ]
+
+        return kept[:self.max_k]
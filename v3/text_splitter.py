@@ -1,16 +1,50 @@
 import tiktoken
+from typing import Iterable, NamedTuple
 
 """Re-implement character text chunking strategy"""
 
+class ChunkSpan(NamedTuple):
+    """
+    Position of a chunk: token range in the tokenized text and character range in the original text
+    """
+    start_token: int
+    end_token: int
+    start_char: int
+    end_char: int
+
+
 class TextSplitter:
     def __init__(self, chunk_size: int, chunk_overlap: int, encoding_name: str = "cl100k_base"):
-        # chunk_size can not equal to chunk_overlap
-        assert chunk_size != chunk_overlap
+        # chunk_overlap must be smaller than chunk_size, otherwise chunks never move forward
+        assert chunk_overlap < chunk_size
 
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
         self.tokenizer = tiktoken.get_encoding(encoding_name)
 
+    def __windows(self, token_count: int):
+        """
+        Yield (start, end) token range of each chunk
+        """
+        # Given n = chunk_overlap. The last n tokens of previous chunk will
+        # be carried over to the beginning of the next chunk
+        start_tkn = 0
+
+        while start_tkn < token_count:
+            end_tkn = min(token_count, start_tkn + self.chunk_size)
+            yield start_tkn, end_tkn
+            start_tkn = start_tkn + self.chunk_size - self.chunk_overlap
+
+    def __spans(self, text: str, tokens: list[int]) -> list[ChunkSpan]:
+        # Character offset of each token, decoded once for the whole text
+        _, offsets = self.tokenizer.decode_with_offsets(tokens)
+        offsets.append(len(text))
+
+        return [
+            ChunkSpan(start_tkn, end_tkn, offsets[start_tkn], offsets[end_tkn])
+            for start_tkn, end_tkn in self.__windows(len(tokens))
+        ]
+
     def split_text(self, text: str):
         # Using gpt embedding model and tiktoken tokenizer
         output: list[str] = []
@@ -18,18 +52,51 @@ class TextSplitter:
         # Tokenize text into list of token ids
         tokens = self.tokenizer.encode(text)
 
-        # Given n = chunk_overlap. The last n tokens of previous chunk will
-        # be carried over to the beginning of the next chunk
-
-        start_tkn = 0
-        
-        while start_tkn < len(tokens):
-            end_tkn = min(len(tokens), start_tkn + self.chunk_size)
+        for start_tkn, end_tkn in self.__windows(len(tokens)):
             output.append(self.tokenizer.decode(tokens[start_tkn:end_tkn]))
-            start_tkn = start_tkn + self.chunk_size - self.chunk_overlap
 
         return output
 
+    def split_spans(self, text: str) -> list[ChunkSpan]:
+        """
+        Split `text` without decoding any chunk. Return list of spans, chunk i is
+        `text[span.start_char:span.end_char]`.
+
+        If a token boundary falls inside a multi-byte character, the character belongs to the chunk that starts with it
+        """
+        return self.__spans(text, self.tokenizer.encode(text))
+
+    def split_batch(self, texts: list[str], num_threads: int = 8) -> list[list[ChunkSpan]]:
+        """
+        Split many documents, tokenized in parallel with tiktoken batch encoder. Return spans of each document
+        """
+        tokens_batch = self.tokenizer.encode_batch(texts, num_threads=num_threads)
+
+        return [self.__spans(text, tokens) for text, tokens in zip(texts, tokens_batch)]
+
+    def iter_chunks(self, pieces: Iterable[str]):
+        """
+        Yield chunks of a text given as consecutive `pieces` (e.g. lines or blocks of a large file),
+        only the tokens of the current chunk are kept in memory.
+
+        Each piece is tokenized separately, so pieces should end at a whitespace or line boundary
+        to get the same tokens as `split_text`
+        """
+        step = self.chunk_size - self.chunk_overlap
+        buffer: list[int] = []
+
+        for piece in pieces:
+            buffer.extend(self.tokenizer.encode(piece))
+
+            while len(buffer) >= self.chunk_size:
+                yield self.tokenizer.decode(buffer[:self.chunk_size])
+                buffer = buffer[step:]
+
+        # Remaining tokens, same as the last chunks of `split_text`
+        while len(buffer) > 0:
+            yield self.tokenizer.decode(buffer[:self.chunk_size])
+            buffer = buffer[step:]
+
 if __name__ == "__main__":
     text_splitter = TextSplitter(2, 1)
     print(text_splitter.split_text("hello word"))
@@ -0,0 +1,234 @@
+"""In-process vector index, used as a fast path of Neo4j vector search"""
+
+import json
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+class VectorIndex:
+    """
+    Cosine similarity index kept in memory. Vectors are L2-normalized and stored in a contiguous float32
+    matrix, a search is a single matrix-vector product. For larger corpora an HNSW graph (requires `hnswlib`)
+    is built on top of the same matrix.
+
+    Each vector has an `id` and an optional `payload`. Adding an existing `id` replaces its vector and payload.
+
+    Parameters
+    -
+    hnsw_threshold: number of vectors from which the HNSW graph is used, if `hnswlib` is installed.
+    None disables HNSW
+    """
+    def __init__(self, dim: int | None = None, hnsw_threshold: int | None = 50000):
+        self.dim = dim
+        self.hnsw_threshold = hnsw_threshold
+
+        self.ids: list = []
+        self.payloads: list = []
+        self.__rows: dict = {}
+        self.__matrix = np.zeros((0, dim or 0), dtype=np.float32)
+        self.__hnsw = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self.__matrix[:len(self.ids)]
+
+    @staticmethod
+    def __normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def add(self, ids: list, vectors, payloads: list | None = None):
+        """
+        Add or replace vectors
+        """
+        vectors = self.__normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        if payloads is None:
+            payloads = [None] * len(ids)
+
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self.__matrix = np.zeros((0, self.dim), dtype=np.float32)
+        assert vectors.shape[1] == self.dim
+
+        for id, vector, payload in zip(ids, vectors, payloads):
+            row = self.__rows.get(id)
+            if row is None:
+                row = len(self.ids)
+                self.__grow(row + 1)
+                self.__rows[id] = row
+                self.ids.append(id)
+                self.payloads.append(payload)
+            else:
+                self.payloads[row] = payload
+
+            self.__matrix[row] = vector
+
+        # HNSW graph is rebuilt on next search
+        self.__hnsw = None
+
+    def remove(self, ids: list):
+        """
+        Remove vectors of `ids`, unknown ids are ignored
+        """
+        dropped = {self.__rows[id] for id in ids if id in self.__rows}
+        if len(dropped) == 0:
+            return
+
+        keep = [row for row in range(len(self.ids)) if row not in dropped]
+        self.__matrix = np.ascontiguousarray(self.matrix[keep])
+        self.ids = [self.ids[row] for row in keep]
+        self.payloads = [self.payloads[row] for row in keep]
+        self.__rows = {id: row for row, id in enumerate(self.ids)}
+
+        # HNSW graph is rebuilt on next search
+        self.__hnsw = None
+
+    def __grow(self, size: int):
+        """
+        Double matrix capacity when it is full, so appending is amortized O(1)
+        """
+        if size <= self.__matrix.shape[0]:
+            return
+
+        matrix = np.zeros((max(size, 2 * self.__matrix.shape[0], 16), self.dim), dtype=np.float32)
+        matrix[:self.__matrix.shape[0]] = self.__matrix
+        self.__matrix = matrix
+
+    def __use_hnsw(self) -> bool:
+        return hnswlib is not None and self.hnsw_threshold is not None and len(self.ids) >= self.hnsw_threshold
+
+    def __build_hnsw(self):
+        index = hnswlib.Index(space='ip', dim=self.dim)
+        index.init_index(max_elements=len(self.ids), ef_construction=200, M=16)
+        index.add_items(self.matrix, np.arange(len(self.ids)))
+        index.set_ef(64)
+        self.__hnsw = index
+
+    def search_batch(self, queries, k: int, where=None) -> list[list[tuple]]:
+        """
+        Return `k` closest `(id, payload, score)` of each query, sorted by cosine similarity.
+
+        If `where` is given, only vectors whose payload satisfies `where(payload)` are searched (exactly, without HNSW)
+        """
+        # Dimension of an empty index is unknown
+        if len(self.ids) == 0:
+            return [[] for _ in range(len(queries))]
+
+        queries = self.__normalize(np.asarray(queries, dtype=np.float32).reshape(-1, self.dim))
+
+        candidates = None
+        if where is not None:
+            candidates = np.flatnonzero([bool(where(payload)) for payload in self.payloads])
+
+        k = min(k, len(self.ids) if candidates is None else len(candidates))
+        if k == 0:
+            return [[] for _ in range(len(queries))]
+
+        if candidates is None and self.__use_hnsw():
+            if self.__hnsw is None:
+                self.__build_hnsw()
+            rows, distances = self.__hnsw.knn_query(queries, k=k)
+            scores = 1 - distances
+        else:
+            matrix = self.matrix if candidates is None else self.matrix[candidates]
+            similarity = queries @ matrix.T
+            rows = np.argpartition(-similarity, k - 1, axis=1)[:, :k]
+            scores = np.take_along_axis(similarity, rows, axis=1)
+
+            order = np.argsort(-scores, axis=1)
+            rows = np.take_along_axis(rows, order, axis=1)
+            scores = np.take_along_axis(scores, order, axis=1)
+
+            # Back to rows of the whole matrix
+            if candidates is not None:
+                rows = candidates[rows]
+
+        return [
+            [(self.ids[row], self.payloads[row], float(score)) for row, score in zip(query_rows, query_scores)]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def search(self, query, k: int, where=None) -> list[tuple]:
+        return self.search_batch([query], k, where)[0]
+
+    def save(self, path: str):
+        """
+        Save index to `path` (.npz), payloads must be JSON serializable
+        """
+        np.savez(
+            path,
+            matrix=self.matrix,
+            meta=np.array(json.dumps({"ids": self.ids, "payloads": self.payloads}))
+        )
+
+    @classmethod
+    def load(cls, path: str, hnsw_threshold: int | None = 50000):
+        data = np.load(path)
+        meta = json.loads(str(data["meta"]))
+
+        index = cls(data["matrix"].shape[1], hnsw_threshold)
+        index.add(meta["ids"], data["matrix"], meta["payloads"])
+        return index
+
+
+
+def load_community_index(kg, index: VectorIndex | None = None) -> VectorIndex:
+    """
+    Load (or sync `index` with) all `Community` nodes and their summary embeddings. Communities which
+    no longer exist in Neo4j are removed from `index`.
+    Community ids are only unique in a level, so vectors are keyed by `"<level>-<id>"`
+    """
+    # Imported here, so the index can be used without Neo4j packages
+    import cypher_query as cq
+
+    if index is None:
+        index = VectorIndex()
+
+    communities = cq.get_communities(kg)
+    ids = [f'{community["level"]}-{community["id"]}' for community in communities]
+
+    current = set(ids)
+    index.remove([id for id in index.ids if id not in current])
+    if len(communities) == 0:
+        return index
+
+    index.add(
+        ids,
+        [community["embedding"] for community in communities],
+        [{
+            "id": community["id"],
+            "level": community["level"],
+            "title": community["title"],
+            "summary": community["summary"],
+            "rating": community["rating"],
+            "re": community["re"],
+            "findings": community["findings"]
+        } for community in communities]
+    )
+
+    return index
+
+
+def search_communities(index: VectorIndex, result_number: int, query, level: int | None = None):
+    """
+    Return `result_number` communities closest to embedding vector `query`, in the same format as
+    `cypher_query.get_search_result`. If `level` is given, only communities of that level are searched
+    """
+    where = None
+    if level is not None:
+        where = lambda payload: payload.get("level", 0) == level
+
+    output = []
+    for _, payload, score in index.search(query, result_number, where):
+        # Same score scale as Neo4j cosine vector index
+        score = (1 + score) / 2
+        output.append([payload["title"], payload["summary"], payload["rating"], payload["re"], payload["findings"], score])
+
+    return output